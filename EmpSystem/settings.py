@@ -56,14 +56,62 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 10
 }
 
+# Badge uid -> employee lookups cached per process for the punch path.
+UID_CACHE_SIZE = 10000
+UID_CACHE_TTL = 300
+
+# Serve the punch endpoints (api/shift/add, api/shift/) from async views; run under an ASGI server.
+PUNCH_ASYNC = False
+
+# Set to a file path (e.g. BASE_DIR / 'punch_journal.sqlite3') to acknowledge punches from a local
+# write-behind journal that a background thread flushes into Shift in batches. The flusher starts with the
+# WSGI/ASGI application and replays what a previous process left behind. Several processes may share one
+# journal file, but only the one holding its '.lock' file flushes, manage.py flush_punch_journal included
+# (needs fcntl; elsewhere, give each process its own journal).
+PUNCH_JOURNAL = None
+PUNCH_JOURNAL_FLUSH_INTERVAL = 1.0
+PUNCH_JOURNAL_BATCH_SIZE = 500
+
+# Repeated punches of one employee within this many seconds are absorbed (0 disables), and responses
+# to requests carrying an Idempotency-Key are replayed for PUNCH_IDEMPOTENCY_TTL seconds. Both live in
+# the default cache, so point CACHES at a shared backend when running several workers.
+PUNCH_DEBOUNCE_SECONDS = 5
+PUNCH_IDEMPOTENCY_TTL = 24 * 60 * 60
+
+# Batch punches (api/shift/batch) may be stamped at most this many seconds ahead of the server clock.
+PUNCH_CLOCK_SKEW_SECONDS = 300
+
+# Seconds a user's owned/employed company ids stay in the cache; saves of Employee/Company invalidate them.
+# They grant access, so they are only cached across requests when CACHES['default'] is shared by all
+# workers (not the process-local LocMemCache); otherwise they are computed once per request.
+MEMBERSHIP_CACHE_TTL = 300
+
+# Seconds small lookup tables (roles) stay cached; saves and deletes of those rows invalidate them.
+CATALOGUE_CACHE_TTL = 300
+
+# Worker processes hashing passwords during CSV employee imports (None: one per CPU).
+ONBOARDING_HASH_WORKERS = None
+
+# Employee QR badges: rendered on first request into BADGE_ROOT (None: BASE_DIR / 'badges'), with the
+# last BADGE_CACHE_SIZE images kept in memory. BADGE_WORKERS processes run `generate_badges` (None: one per CPU).
+BADGE_ROOT = None
+BADGE_CACHE_SIZE = 512
+BADGE_WORKERS = None
+
 ROOT_URLCONF = 'EmpSystem.urls'
 
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [],
-        'APP_DIRS': True,
         'OPTIONS': {
+            # Compiled templates are kept in memory; under runserver they are reloaded when a file changes.
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'EmpSystem.settings')
 
 application = get_wsgi_application()
+
+# Serving processes flush the punch journal (and replay what a crashed one left behind).
+from main.helper.journal import get_punch_journal  # noqa: E402
+
+get_punch_journal()
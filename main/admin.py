@@ -1,5 +1,6 @@
 from django.contrib import admin
 from . import models
+from .helper.summary import refresh_summaries, shift_days
 
 
 class ShiftColumn(admin.ModelAdmin):
@@ -9,6 +10,14 @@ class ShiftColumn(admin.ModelAdmin):
     def company(self, obj):
         return f"{obj.employee.company}"
 
+    def delete_queryset(self, request, queryset):
+        # A bulk delete skips Shift.delete, so the summary days are refreshed here.
+        days = {}
+        for employee_id, enter_time, exit_time in queryset.values_list('employee_id', 'enter_time', 'exit_time'):
+            days.setdefault(employee_id, set()).update(shift_days(enter_time, exit_time))
+        super().delete_queryset(request, queryset)
+        refresh_summaries(days)
+
 
 class EmployeeColumn(admin.ModelAdmin):
     list_display = ('username', 'full_name', 'email', 'phone_number', 'company', 'role')
@@ -36,6 +45,12 @@ class CompanyColumns(admin.ModelAdmin):
     def owner(self, obj):
         return f"{obj.created_by}"
 
+class ShiftDailySummaryColumns(admin.ModelAdmin):
+    list_display = ('date', 'company', 'employee', 'hours', 'shifts')
+    list_filter = ('date', )
+    list_select_related = ('company', 'employee__user')
+
+
 class ProfileColumns(admin.ModelAdmin):
     list_display = ('user', 'phone_number')
     search_fields = ('user__username', )
@@ -45,5 +60,6 @@ class ProfileColumns(admin.ModelAdmin):
 admin.site.register(models.Employee, EmployeeColumn)
 admin.site.register(models.Company, CompanyColumns)
 admin.site.register(models.Shift, ShiftColumn)
+admin.site.register(models.ShiftDailySummary, ShiftDailySummaryColumns)
 admin.site.register(models.Role)
 admin.site.register(models.Profile, ProfileColumns)
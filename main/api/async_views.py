@@ -0,0 +1,103 @@
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.http import JsonResponse
+from django.views import View
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from ..models import Shift
+from .views import ShiftView
+from ..helper.exceptions import CustomError, ForbiddenException
+from ..helper.punch import idempotency_key, idempotency_cache_key, idempotency_ttl
+
+
+def _authenticate(request):
+    """
+    The user as the sync DRF views see it: DRF's authentication classes (basic auth, and the
+    session with its CSRF check), or None when a presented credential fails, which DRF rejects.
+    """
+    authenticators = [authenticator() for authenticator in api_settings.DEFAULT_AUTHENTICATION_CLASSES]
+    try:
+        return Request(request, authenticators=authenticators).user
+    except APIException:
+        return None
+
+
+async def aget_user(request):
+    if not hasattr(request, '_api_user'):
+        request._api_user = await sync_to_async(_authenticate)(request)
+    return request._api_user
+
+
+class AsyncDefaultView(View):
+    """
+    Plain async Django views for the punch endpoints; DRF's APIView cannot run natively async.
+    Handlers return a (payload, status) pair that is rendered as JSON. Like APIView, they
+    authenticate with DRF's classes and leave the CSRF check to session authentication.
+    """
+    access_denied = ({'details': 'Accesss Denied.'}, status.HTTP_403_FORBIDDEN)
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        view.csrf_exempt = True
+        return view
+
+    async def idempotent(self, request, handler):
+        user = await aget_user(request)
+        if user is None:
+            payload, code = self.access_denied
+            return JsonResponse(payload, status=code)
+
+        key = idempotency_key(request) and idempotency_cache_key(request, user)
+        if not key:
+            payload, code = await handler(request)
+            return JsonResponse(payload, status=code)
+
+        replay = await cache.aget(key)
+        if not replay:
+            replay = await handler(request)
+            await cache.aset(key, replay, idempotency_ttl())
+
+        payload, code = replay
+        return JsonResponse(payload, status=code)
+
+
+class AsyncShiftAddView(AsyncDefaultView):
+    async def punch(self, request):
+        try:
+            result = await Shift().aadd_shift_by_uid(request.GET.get('uid', None))
+            return {'details': result}, status.HTTP_200_OK
+        except ForbiddenException:
+            return self.access_denied
+        except CustomError as e:
+            return {'details': str(e)}, status.HTTP_400_BAD_REQUEST
+
+    async def get(self, request, **kwargs):
+        return await self.idempotent(request, self.punch)
+
+
+class AsyncShiftView(AsyncDefaultView):
+    async def punch(self, request):
+        user = await aget_user(request)
+        if not user.is_authenticated:
+            return self.access_denied
+
+        try:
+            company_id = request.GET.get('company_id', None)
+            result = await Shift().aadd_shift(user, company_id)
+        except ForbiddenException:
+            return self.access_denied
+        except CustomError as e:
+            result = str(e)
+
+        return {'details': result}, status.HTTP_200_OK
+
+    async def get(self, request):
+        # Listing is not on the punch hot path; hand it to the DRF view in a worker thread.
+        return await sync_to_async(ShiftView.as_view())(request)
+
+    async def post(self, request):
+        return await self.idempotent(request, self.punch)
@@ -0,0 +1,18 @@
+from rest_framework.permissions import BasePermission, SAFE_METHODS
+
+
+class IsStaffOrReadOnly(BasePermission):
+    """Anyone the view lets in may read; only staff may write."""
+
+    def has_permission(self, request, view):
+        return request.method in SAFE_METHODS or request.user.is_staff
+
+
+class IsCompanyOwnerOrReadOnly(BasePermission):
+    """
+    Objects are written only by the owner of the company they belong to, which the view
+    resolves with ``owner_id(obj)``; reads stay limited by the view's own queryset.
+    """
+
+    def has_object_permission(self, request, view, obj):
+        return request.method in SAFE_METHODS or view.owner_id(obj) == request.user.id
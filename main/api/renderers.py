@@ -0,0 +1,18 @@
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils import encoders
+
+try:
+    import orjson
+except ImportError:  # optional; falls back to the stdlib encoder DRF uses
+    orjson = None
+
+
+class FastJSONRenderer(JSONRenderer):
+    """JSONRenderer that encodes with orjson when it is installed."""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None or self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        # A many=True serializer keys its errors by row index; orjson only accepts non-str keys with this option.
+        return orjson.dumps(data, default=encoders.JSONEncoder().default, option=orjson.OPT_NON_STR_KEYS)
@@ -1,5 +1,12 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.utils import timezone
 from rest_framework import serializers
 from ..models import Company, Role, Employee, Shift, User, Profile
+from ..helper.catalogue import role_catalogue
+from ..helper.uniqueness import find_taken_fields, integrity_error_field, normalize_email, normalize_phone
 
 
 class ProfileSerializer(serializers.ModelSerializer):
@@ -8,13 +15,51 @@ class ProfileSerializer(serializers.ModelSerializer):
         fields = ('phone_number', )
 
 
-class ShowUserSerializer(serializers.ModelSerializer):
+class CatalogueRelatedField(serializers.PrimaryKeyRelatedField):
+    """Foreign key to a ReferenceCatalogue model, validated and listed from the cache instead of a query."""
+
+    def __init__(self, catalogue, **kwargs):
+        self.catalogue = catalogue
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        obj = self.catalogue.get(data)
+        if obj is None:
+            self.fail('does_not_exist', pk_value=data)
+        return obj
+
+    def get_choices(self, cutoff=None):
+        rows = self.catalogue.rows()
+        return dict(rows[:cutoff] if cutoff is not None else rows)
+
+
+class SparseFieldsMixin:
+    """Keeps only the serializer fields named in ``fields`` (the ``?fields=`` sparse fieldset)."""
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
+class ShowUserSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     profile = ProfileSerializer(read_only=True)
+    # Contact details are only shown to the user they belong to.
+    private_fields = ('email', 'profile')
 
     class Meta:
         model = User
         fields = ('id', 'username', 'email', 'profile')
 
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        request = self.context.get('request')
+        if request is None or request.user.pk != instance.pk:
+            for name in self.private_fields:
+                data.pop(name, None)
+        return data
+
 
 class EditUserSerializer(serializers.Serializer):
     username = serializers.CharField(max_length=255)
@@ -29,33 +74,33 @@ class EditUserSerializer(serializers.Serializer):
             'phone_number': {'write_only': True}
         }
 
-    def validate_data(self, validated_data, instance=None):
-        mail = validated_data['email']
-        username = validated_data['username']
-        number = validated_data['phone_number']
-        email_obj = User.objects.filter(email=mail)
-        user_name_obj = User.objects.filter(username=username)
-        number_obj = User.objects.filter(profile__phone_number=number)
-
-        error_data = {}
+    messages = {
+        'email': 'Email already exists.',
+        'username': 'Username already exists.',
+        'phone_number': 'Phone number already exists.',
+    }
 
-        check_mail = instance.email != mail if instance else True
-        check_username = instance.username != username if instance else True
-        try:
-            check_number = instance.profile.phone_number != number if instance else True
-        except Exception as e:
-            check_number = True
+    def validate_email(self, value):
+        return normalize_email(value)
 
-        if email_obj.count() and check_mail:
-            error_data.update({'email': 'Email already exists.'})
+    def validate_phone_number(self, value):
+        return normalize_phone(value)
 
-        if user_name_obj.count() and check_username:
-            error_data.update({'username': 'Username already exists.'})
-
-        if number_obj.count() and check_number:
-            error_data.update({'phone_number': 'Phone number already exists.'})
+    def validate_data(self, validated_data, instance=None):
+        taken = find_taken_fields(validated_data['username'], validated_data['email'],
+                                  validated_data['phone_number'], exclude=instance.pk if instance else None)
+        return {field: message for field, message in self.messages.items() if field in taken}
 
-        return error_data
+    def write(self, save):
+        """Run ``save`` atomically; a unique constraint lost to a concurrent write becomes a 400."""
+        try:
+            with transaction.atomic():
+                return save()
+        except IntegrityError as e:
+            field = integrity_error_field(e)
+            if not field:
+                raise
+            raise serializers.ValidationError({field: self.messages[field]})
 
     def create(self, validated_data):
         mail = validated_data['email']
@@ -66,12 +111,15 @@ class EditUserSerializer(serializers.Serializer):
         if error_data:
             raise serializers.ValidationError(error_data)
 
-        instant = User.objects.create(username=username, email=mail)
-        instant.set_password(self.validated_data['password'])
-        instant.save()
-        instant.profile.phone_number = number
-        instant.profile.save()
-        return instant
+        def save():
+            instant = User(username=username, email=mail)
+            instant.set_password(self.validated_data['password'])
+            instant.save()
+            # The profile row is created by the User post_save signal.
+            Profile.objects.filter(user=instant).update(phone_number=number)
+            return instant
+
+        return self.write(save)
 
     def update(self, instance, validated_data):
         error_data = self.validate_data(self.validated_data, instance)
@@ -82,19 +130,14 @@ class EditUserSerializer(serializers.Serializer):
             user_obj = User.objects.get(id=instance.id)
         except User.DoesNotExist:
             raise serializers.ValidationError({'User': 'User does not exist'})
-        else:
+
+        def save():
             user_obj.username = validated_data.get('username', instance.username)
             user_obj.email = validated_data.get('email', instance.email)
 
-            try:
-                user_obj.profile.phone_number = validated_data.get('phone_number', instance.profile.phone_number)
-                user_obj.profile.save()
-            except Exception as e:
-                obj = Profile.objects.create(
-                    user=user_obj,
-                    phone_number=validated_data.get('phone_number', None)
-                )
-                obj.save()
+            number = validated_data.get('phone_number', None)
+            if not Profile.objects.filter(user=user_obj).update(phone_number=number):
+                Profile.objects.create(user=user_obj, phone_number=number)
 
             password = validated_data.get('password', None)
             if password:
@@ -103,26 +146,76 @@ class EditUserSerializer(serializers.Serializer):
             user_obj.save()
             return user_obj
 
+        return self.write(save)
+
+
+class SparseModelSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    """
+    Sparse ModelSerializer that can also represent plain ``QuerySet.values()`` rows
+    without building model instances. Subclasses must only declare fields that map
+    onto a model column.
+    """
+    # Values from these fields come out of values() already in their JSON form.
+    raw_fields = (serializers.IntegerField, serializers.CharField, serializers.BooleanField,
+                  serializers.PrimaryKeyRelatedField)
+
+    def value_columns(self):
+        """Serializer field name -> column name to pass to values()."""
+        opts = self.Meta.model._meta
+        return {name: opts.get_field(field.source).attname for name, field in self.fields.items()}
 
-class CompanySerializer(serializers.ModelSerializer):
+    def represent_values(self, rows):
+        columns = list(self.value_columns().items())
+        convert = {name: field.to_representation for name, field in self.fields.items()
+                   if not isinstance(field, self.raw_fields)}
+
+        result = []
+        for row in rows:
+            item = {}
+            for name, column in columns:
+                value = row[column]
+                item[name] = convert[name](value) if value is not None and name in convert else value
+            result.append(item)
+        return result
+
+
+class CompanySerializer(SparseModelSerializer):
     class Meta:
         model = Company
         exclude = ('is_deleted', )
+        read_only_fields = ('created_by', )
 
 
-class RoleSerializer(serializers.ModelSerializer):
+class RoleSerializer(SparseModelSerializer):
     class Meta:
         model = Role
         exclude = ('is_deleted', )
 
 
-class EmployeeSerializer(serializers.ModelSerializer):
+class EmployeeSerializer(SparseModelSerializer):
+    role = CatalogueRelatedField(role_catalogue, queryset=Role.objects.all())
+
     class Meta:
         model = Employee
         exclude = ('is_deleted', )
+        # Set by EmployeeView.post; invitations are accepted from the panel.
+        read_only_fields = ('user', 'company', 'uid', 'is_accepted')
 
 
-class ShiftSerializer(serializers.ModelSerializer):
+class ShiftSerializer(SparseModelSerializer):
     class Meta:
         model = Shift
         exclude = ('is_deleted',)
+
+
+class PunchSerializer(serializers.Serializer):
+    uid = serializers.CharField(max_length=20)
+    timestamp = serializers.DateTimeField()
+
+    def validate_timestamp(self, value):
+        # A shift opened in the future could only be closed backwards, and would make every
+        # earlier punch of the employee look like a duplicate.
+        skew = timedelta(seconds=getattr(settings, 'PUNCH_CLOCK_SKEW_SECONDS', 300))
+        if value > timezone.now() + skew:
+            raise serializers.ValidationError("Punch time is in the future.")
+        return value
@@ -1,7 +1,26 @@
-from django.contrib import admin
+from django.conf import settings
 from django.urls import path
-from .views import ShiftAddView
+from .views import (UserView, CompanyView, RoleView, EmployeeView, ShiftView, ShiftAddView,
+                    ShiftBatchAddView)
+from .async_views import AsyncShiftAddView, AsyncShiftView
+
+# PUNCH_ASYNC serves the punch endpoints from native async views (run under an ASGI server).
+if settings.PUNCH_ASYNC:
+    shift_add_view, shift_view = AsyncShiftAddView.as_view(), AsyncShiftView.as_view()
+else:
+    shift_add_view, shift_view = ShiftAddView.as_view(), ShiftView.as_view()
 
 urlpatterns = [
-    path('shift/add', ShiftAddView.as_view(), name='update-shift'),
-]
\ No newline at end of file
+    path('user/', UserView.as_view(), name='user-list'),
+    path('user/<int:pk>/', UserView.as_view(), name='user-details'),
+    path('company/', CompanyView.as_view(), name='company-list'),
+    path('company/<int:pk>/', CompanyView.as_view(), name='company-details'),
+    path('role/', RoleView.as_view(), name='role-list'),
+    path('role/<int:pk>/', RoleView.as_view(), name='role-details'),
+    path('employee/', EmployeeView.as_view(), name='employee-list'),
+    path('employee/<int:pk>/', EmployeeView.as_view(), name='employee-details'),
+    path('shift/add', shift_add_view, name='update-shift'),
+    path('shift/batch', ShiftBatchAddView.as_view(), name='batch-shift'),
+    path('shift/', shift_view, name='shift-list'),
+    path('shift/<int:pk>/', ShiftView.as_view(), name='shift-details'),
+]
@@ -1,20 +1,49 @@
 from rest_framework.views import APIView
-from django.http import Http404
+from rest_framework.renderers import BrowsableAPIRenderer
+from rest_framework.settings import api_settings
+from django.http import Http404, StreamingHttpResponse
 from ..models import Company, Role, Employee, Shift, User
 from .serializers import (CompanySerializer, RoleSerializer, EmployeeSerializer,
-                          ShiftSerializer, EditUserSerializer, ShowUserSerializer)
+                          ShiftSerializer, EditUserSerializer, ShowUserSerializer, PunchSerializer,
+                          SparseModelSerializer)
+from .renderers import FastJSONRenderer
+from .permissions import IsStaffOrReadOnly, IsCompanyOwnerOrReadOnly
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.permissions import IsAuthenticated, AllowAny
 from django.shortcuts import redirect
 from django.db.models import Q
+from django.db import IntegrityError, transaction
+
+from django.core.cache import cache
 
 from ..helper.exceptions import CustomError, ForbiddenException
+from ..helper.punch import idempotency_cache_key, idempotency_ttl
+from ..helper.utils import keyset_paginate, keyset_ordering
+from ..helper.membership import get_membership
+from ..helper.search import search_filter
+from ..helper.conditional import conditional_response, is_versioned, probe
 
 
 class DefaultView(APIView):
     serializer_class = None
     object_class = None
     redirect_url = None
+    renderer_classes = (FastJSONRenderer, BrowsableAPIRenderer)
+    permission_classes = [IsAuthenticated]
+    # ?fields=a,b limits the response to those serializer fields.
+    fields_param = 'fields'
+    # Query-string parameter -> lookup. Only these parameters filter the list; anything else is ignored.
+    # ``__prefix`` lookups are case-sensitive so that they stay index range scans (see helper/search.py);
+    # case-insensitive matching is what the ``q`` full-text search is for.
+    search_fields = {}
+    # (document kind, relation to it) searched by the ``q`` parameter, see helper/search.py.
+    full_text_search = None
+    search_param = 'q'
+    # Lists are keyset paginated (see helper/utils.py); ?stream=1 returns the whole result as chunked JSON.
+    default_keyset = (('id', False, None), )
+    stream_param = 'stream'
+    stream_chunk_size = 500
 
     def get_query(self, request, fetch="or", **query):
         set_query = Q()
@@ -25,20 +54,29 @@ class DefaultView(APIView):
                 set_query &= Q(**{k: v})
         return set_query
 
-    def get_object(self, request, pk=None):
-        query = self.get_query(request)
-
+    def get_search_query(self, request):
         search_query = Q()
-        for key in request.GET.keys():
-            if key != 'format':
-                search_query = search_query & Q(**{f"{key}__contains": request.GET[key]})
+        for key, lookup in self.search_fields.items():
+            value = request.GET.get(key)
+            if value:
+                search_query &= Q(**{lookup: value})
+
+        term = request.GET.get(self.search_param)
+        if term and self.full_text_search:
+            search_query &= search_filter(*self.full_text_search, term)
 
-        query &= search_query if search_query != Q() else query
+        return search_query
+
+    def get_queryset(self):
+        return self.object_class.objects
+
+    def get_object(self, request, pk=None):
+        query = self.get_query(request) & self.get_search_query(request)
         try:
             if pk:
-                obj = self.object_class.objects.get(Q(id=pk) & query)
+                obj = self.get_queryset().get(Q(id=pk) & query)
             else:
-                obj = self.object_class.objects.filter(query)
+                obj = self.get_queryset().filter(query)
 
         except self.object_class.DoesNotExist:
             raise Http404
@@ -47,24 +85,113 @@ class DefaultView(APIView):
             print(e)
             raise Http404
 
-        if not obj:
-            raise Http404
-
+        if pk:
+            self.check_object_permissions(request, obj)
         return obj, True if not pk else False
 
+    def get_keyset(self):
+        return getattr(self.object_class.objects, 'keyset', None) or self.default_keyset
+
+    def serializer_kwargs(self, request):
+        kwargs = {'context': {'request': request, 'view': self}}
+        fields = request.GET.get(self.fields_param)
+        if fields:
+            kwargs['fields'] = [name for name in fields.split(',') if name]
+        return kwargs
+
+    def list_source(self, request, queryset):
+        """
+        ``(rows, represent)`` for a list response. Serializers that support it read a values()
+        queryset narrowed to the requested columns, and ``represent`` turns those rows into
+        dicts without building model instances; other serializers get model instances.
+        """
+        kwargs = self.serializer_kwargs(request)
+        if not issubclass(self.serializer_class, SparseModelSerializer):
+            return queryset, lambda rows: self.serializer_class(rows, many=True, **kwargs).data
+
+        serializer = self.serializer_class(**kwargs)
+        opts = queryset.model._meta
+        columns = set(serializer.value_columns().values())
+        columns.update(opts.get_field(name).attname for name, descending, nulls_first in self.get_keyset())
+        return queryset.values(*columns), serializer.represent_values
+
+    def paginated(self, request, queryset):
+        rows, represent = self.list_source(request, queryset)
+        page = keyset_paginate(request.GET.get('cursor'), rows, self.get_keyset(), api_settings.PAGE_SIZE)
+        return Response({
+            'next': page.next_cursor,
+            'previous': page.previous_cursor,
+            'results': represent(page.object_list)
+        }, status=status.HTTP_200_OK)
+
+    def streamed(self, request, queryset):
+        """Serialize ``queryset`` chunk by chunk into one JSON array, holding one chunk in memory at a time."""
+        rows, represent = self.list_source(request, queryset)
+        renderer = FastJSONRenderer()
+        chunk_size = self.stream_chunk_size
+
+        def render(chunk):
+            return renderer.render(represent(chunk))[1:-1]
+
+        def content():
+            yield b'['
+            separator, chunk = b'', []
+            for obj in rows.order_by(*keyset_ordering(self.get_keyset())).iterator(chunk_size=chunk_size):
+                chunk.append(obj)
+                if len(chunk) == chunk_size:
+                    yield separator + render(chunk)
+                    separator, chunk = b',', []
+            if chunk:
+                yield separator + render(chunk)
+            yield b']'
+
+        return StreamingHttpResponse(content(), content_type='application/json')
+
     def access_denied(self):
         return Response({'details': 'Accesss Denied.'}, status=status.HTTP_403_FORBIDDEN)
 
+    def idempotent(self, request, handler):
+        """Run handler once per Idempotency-Key and replay its response for repeated requests."""
+        key = idempotency_cache_key(request, request.user)
+        if not key:
+            return handler(request)
+
+        replay = cache.get(key)
+        if replay:
+            return Response(replay[0], status=replay[1])
+
+        response = handler(request)
+        cache.set(key, (response.data, response.status_code), idempotency_ttl())
+        return response
+
     def get(self, request, pk=None):
         _obj, many = self.get_object(request, pk)
-        serializer = self.serializer_class(_obj, many=many)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        if not many:
+            return Response(self.serializer_class(_obj, **self.serializer_kwargs(request)).data,
+                            status=status.HTTP_200_OK)
+
+        if not is_versioned(self.object_class):
+            return self.list_response(request, _obj)
+
+        # Pollers get a 304 from one aggregate query instead of a fetched and rendered page.
+        return conditional_response(request, [probe(_obj)], lambda: self.list_response(request, _obj),
+                                    request.accepted_renderer.format)
+
+    def list_response(self, request, queryset):
+        if request.GET.get(self.stream_param):
+            return self.streamed(request, queryset)
+
+        return self.paginated(request, queryset)
 
     def post(self, request):
+        return self.create(request)
+
+    def create(self, request, **save_kwargs):
+        """Validate the request body and save it together with ``save_kwargs`` (read-only fields set by the view)."""
         serializer = self.serializer_class(data=request.data)
 
         if serializer.is_valid():
-            obj = serializer.save()
+            obj = serializer.save(**save_kwargs)
             return redirect(self.redirect_url, pk=obj.id)
 
         return Response(serializer.errors, status=status.HTTP_201_CREATED)
@@ -96,9 +223,20 @@ class UserView(DefaultView):
     serializer_class = EditUserSerializer
     object_class = User
     redirect_url = "user-details"
+    search_fields = {'username': 'username__prefix'}
+    full_text_search = ('user', '')
 
     def get_query(self, request, fetch="or", **query):
-        return super().get_query(request, **{"username": request.GET.get('username', None)})
+        # Others are only found by looking them up (a pk or a search), never listed wholesale,
+        # and ShowUserSerializer keeps their contact details private.
+        if request.user.is_staff:
+            return Q()
+        if self.kwargs.get('pk') or self.get_search_query(request):
+            return Q(pk=request.user.pk) | Q(is_active=True)
+        return Q(pk=request.user.pk)
+
+    def get_queryset(self):
+        return User.objects.select_related('profile')
 
     def get(self, request, pk=None):
         self.serializer_class = ShowUserSerializer
@@ -108,54 +246,95 @@ class UserView(DefaultView):
         uid = request.user.id if request.user else None
         return super().put(request, pk=uid)
 
+    def delete(self, request, pk=None):
+        return self.access_denied()
+
 
 class CompanyView(DefaultView):
     serializer_class = CompanySerializer
     object_class = Company
     redirect_url = "company-details"
+    search_fields = {'name': 'name__prefix', 'city': 'city__prefix', 'number': 'number'}
+    full_text_search = ('company', '')
+    permission_classes = [IsAuthenticated, IsCompanyOwnerOrReadOnly]
 
     def get_query(self, request, fetch="or", **query):
-        return super().get_query(request, **{"employees__user": request.user, "created_by": request.user})
+        membership = get_membership(request)
+        return super().get_query(request, **{"id__in": membership.owned | membership.employed})
+
+    def owner_id(self, obj):
+        return obj.created_by_id
 
     def post(self, request):
-        request.data['created_by'] = request.user.id
-        return super().post(request)
+        return self.create(request, created_by=request.user)
 
 
 class RoleView(DefaultView):
     serializer_class = RoleSerializer
     object_class = Role
     redirect_url = "role-details"
+    search_fields = {'name': 'name__prefix'}
+    # Roles are shared by every company.
+    permission_classes = [IsAuthenticated, IsStaffOrReadOnly]
 
 
 class EmployeeView(DefaultView):
     serializer_class = EmployeeSerializer
     object_class = Employee
     redirect_url = "employee-details"
+    search_fields = {'uid': 'uid', 'company': 'company_id', 'role': 'role_id', 'user': 'user_id'}
+    full_text_search = ('user', 'user')
+    permission_classes = [IsAuthenticated, IsCompanyOwnerOrReadOnly]
 
     def get_query(self, request, fetch="or", **query):
-        return super().get_query(request, **{"user": request.user, "company__created_by": request.user})
+        return super().get_query(request, **{"user": request.user, "company_id__in": get_membership(request).owned})
+
+    def get_queryset(self):
+        return Employee.objects.select_related('company')
+
+    def owner_id(self, obj):
+        return obj.company.created_by_id
 
     def post(self, request):
-        try:
-            comp_obj = Company.objects.get(created_by=request.user)
-        except Company.DoesNotExist:
+        company = Company.objects.filter(id=request.data.get('company'), created_by=request.user).first()
+        if not company:
             return self.access_denied()
-        else:
-            request.data['company'] = comp_obj.id
-            return super().post(request)
+
+        user = User.objects.filter(id=request.data.get('user')).first()
+        if not user:
+            return Response({'user': ['User does not exist.']}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            with transaction.atomic():
+                return self.create(request, user=user, company=company)
+        except IntegrityError:
+            return Response({'user': ['Employee is already joined to this company!']},
+                            status=status.HTTP_400_BAD_REQUEST)
 
 
 class ShiftView(DefaultView):
     serializer_class = ShiftSerializer
     object_class = Shift
     redirect_url = "shift-details"
+    search_fields = {'employee': 'employee_id', 'company': 'employee__company_id'}
+    full_text_search = ('user', 'employee__user')
+    permission_classes = [IsAuthenticated, IsCompanyOwnerOrReadOnly]
 
     def get_query(self, request, fetch="or", **query):
-        qq = {"employee__user": request.user, "employee__company__created_by": request.user}
-        return super().get_query(request, **qq)
+        # One IN (subquery) on the indexed employee column instead of ORing two joins.
+        visible = Employee.objects_all.filter(Q(user=request.user) | Q(company_id__in=get_membership(request).owned))
+        return super().get_query(request, **{"employee_id__in": visible.values('id')})
+
+    def get_queryset(self):
+        return Shift.objects.select_related('employee__company')
+
+    def owner_id(self, obj):
+        return obj.employee.company.created_by_id
+
+    def punch(self, request):
+        if not request.user.is_authenticated:
+            return self.access_denied()
 
-    def post(self, request):
         try:
             obj = Shift()
             company_id = request.GET.get('company_id', None)
@@ -163,25 +342,34 @@ class ShiftView(DefaultView):
         except ForbiddenException:
             return self.access_denied()
         except CustomError as e:
-            result = e
+            result = str(e)
 
         return Response({'details': result})
 
+    def post(self, request):
+        return self.idempotent(request, self.punch)
+
     def put(self, request, pk=None):
         return self.access_denied()
 
 
 class ShiftAddView(DefaultView):
-    def get(self, request, **kwargs):
+    # Kiosks are not signed in; the badge uid is the credential.
+    permission_classes = [AllowAny]
+
+    def punch(self, request):
         try:
             result = Shift().add_shift_by_uid(request.GET.get('uid', None))
             return Response({'details': result})
         except ForbiddenException:
             return self.access_denied()
         except CustomError as e:
-            result = e
+            result = str(e)
             return Response({'details': result}, status=status.HTTP_400_BAD_REQUEST)
 
+    def get(self, request, **kwargs):
+        return self.idempotent(request, self.punch)
+
     def post(self, request):
         raise Http404
 
@@ -192,3 +380,56 @@ class ShiftAddView(DefaultView):
         raise Http404
 
 
+class ShiftBatchAddView(DefaultView):
+    # Offline kiosks replay punches by badge uid, like shift/add.
+    permission_classes = [AllowAny]
+    serializer_class = PunchSerializer
+    max_punches = 5000
+
+    def get(self, request, pk=None):
+        raise Http404
+
+    def post(self, request):
+        if len(request.data) > self.max_punches:
+            return Response({'details': f"At most {self.max_punches} punches are accepted per request."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = self.serializer_class(data=request.data, many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        punches = serializer.validated_data
+
+        # Same rule as resolve_uid: accepted, not removed, and the company not deleted.
+        employees = dict(Employee.objects.filter(uid__in={item['uid'] for item in punches}, company__is_deleted=False)
+                         .values_list('uid', 'id'))
+        known = [item for item in punches if item['uid'] in employees]
+
+        try:
+            applied = Shift.objects.apply_punches([(employees[item['uid']], item['timestamp']) for item in known])
+        except IntegrityError:
+            return Response({'details': 'Shifts changed while applying punches, please retry.'},
+                            status=status.HTTP_409_CONFLICT)
+
+        applied = iter(applied)
+        result = []
+        for item in punches:
+            if item['uid'] not in employees:
+                state, details = 'rejected', 'Access denied.'
+            else:
+                state = next(applied)
+                if state == 'duplicate':
+                    details = 'Punch already recorded.'
+                else:
+                    details = Shift.punch_message(state == 'started', item['timestamp'])
+
+            result.append({'uid': item['uid'], 'timestamp': item['timestamp'], 'status': state, 'details': details})
+
+        return Response(result)
+
+    def put(self, request, pk=None):
+        raise Http404
+
+    def delete(self, request, pk=None):
+        raise Http404
+
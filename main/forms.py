@@ -1,5 +1,9 @@
 from django import forms
-from .models import Company, Employee, User, Profile, Role
+from .models import Company, Employee, User, Profile
+from .helper.catalogue import role_catalogue
+from .helper.uniqueness import (conflicting_users, taken_fields, find_taken_fields, integrity_error_field,
+                                normalize_email, normalize_phone)
+from django.db import transaction
 from django.db.utils import IntegrityError
 import re
 
@@ -13,16 +17,40 @@ class CompanyForm(forms.ModelForm):
         }
 
 
-class EmployeeForm(forms.ModelForm):
-    GENDER_CHOICES = []
-    roles = Role.objects.all()
+class UniqueContactMixin:
+    """
+    Username, email and phone number are checked with the single query of helper/uniqueness.py
+    instead of ModelForm's per-field checks; a write that still loses a race to a concurrent one
+    is reported through ``save_or_report`` from the database constraint.
+    """
 
-    for role in roles:
-        GENDER_CHOICES.append((role.id, role.name))
+    def clean_email(self):
+        return normalize_email(self.cleaned_data.get('email'))
 
+    def clean_phone_number(self):
+        return normalize_phone(self.cleaned_data.get('phone_number'))
+
+    def validate_unique(self):
+        # Username is part of the uniqueness query in clean().
+        pass
+
+    def save_or_report(self):
+        try:
+            with transaction.atomic():
+                return self.save()
+        except IntegrityError as e:
+            field = integrity_error_field(e)
+            if field not in self.fields:
+                raise
+            real_name = re.sub('_', ' ', field).capitalize()
+            self.add_error(field, f'{real_name} is already in use!')
+            return None
+
+
+class EmployeeForm(UniqueContactMixin, forms.ModelForm):
     username = forms.CharField(max_length=255)
     password = forms.CharField(widget=forms.PasswordInput(), required=False)
-    role = forms.ChoiceField(choices=GENDER_CHOICES)
+    role = forms.ChoiceField(choices=role_catalogue.choices)
     phone_number = forms.CharField(max_length=13, required=False)
     email = forms.EmailField(required=False)
 
@@ -38,57 +66,54 @@ class EmployeeForm(forms.ModelForm):
         self.get_role = None
 
     def clean(self):
-        profile_check = Profile.objects.filter(phone_number=self.cleaned_data['phone_number'])
-        user_check = User.objects.filter(username=self.cleaned_data['username'])
-        email_check = User.objects.filter(email=self.cleaned_data['email'])
-        employee_check = Employee.objects.filter(user__username=self.cleaned_data['username'],
-                                                 company_id=self.company_id)
-
-        company_check = Company.objects.filter(id=self.company_id, created_by=self.request.user)
-
-        if self.request.user.username == self.cleaned_data['username']:
+        username = self.cleaned_data.get('username')
+        if self.request.user.username == username:
             raise forms.ValidationError({'username': 'You can not add yourself as Employee!'})
 
-        try:
-            self.get_role = Role.objects.get(id=self.cleaned_data['role'])
-        except Role.DoesNotExist:
+        self.get_role = role_catalogue.get(self.cleaned_data.get('role'))
+        if not self.get_role:
             raise forms.ValidationError({'role': 'Role does not exists!'})
 
-        if employee_check.count():
-            raise forms.ValidationError({'username': 'Employee is already joined to this company!'})
-
-        if not company_check.count():
+        if not Company.objects.filter(id=self.company_id, created_by=self.request.user).exists():
             raise forms.ValidationError('Company id is invalid!')
 
-        if user_check.count():
-            self.user_exists = user_check.first()
+        users = conflicting_users(username, self.cleaned_data.get('email'), self.cleaned_data.get('phone_number'))
+        self.user_exists = next((user for user in users if user.username == username), None)
+
+        if self.user_exists:
+            if Employee.objects.filter(user=self.user_exists, company_id=self.company_id).exists():
+                raise forms.ValidationError({'username': 'Employee is already joined to this company!'})
         else:
             for key in self.fields.keys():
-                if not self.cleaned_data[key]:
+                if not self.cleaned_data.get(key):
                     real_name = re.sub('_', ' ', key).capitalize()
                     raise forms.ValidationError({key: f'{real_name} can not be empty.'})
 
-            if profile_check.count():
+            taken = taken_fields(users, email=self.cleaned_data['email'],
+                                 phone_number=self.cleaned_data['phone_number'])
+            if 'phone_number' in taken:
                 raise forms.ValidationError({'phone_number': 'Phone number is already in use!'})
 
-            if email_check.count():
+            if 'email' in taken:
                 raise forms.ValidationError({'email': 'Email is already in use!'})
 
         return self.cleaned_data
 
     def save(self, commit=True):
         if not self.user_exists:
-            obj = super().save(commit=commit)
+            obj = super().save(commit=False)
             obj.set_password(self.cleaned_data['password'])
-            obj.profile.phone_number = self.cleaned_data['phone_number']
-            obj.profile.save()
             obj.save()
+            # The profile row is created by the User post_save signal.
+            if not Profile.objects.filter(user=obj).update(phone_number=self.cleaned_data['phone_number']):
+                Profile.objects.create(user=obj, phone_number=self.cleaned_data['phone_number'])
         else:
             obj = self.user_exists
         try:
-            obj = Employee.objects.create(user=obj,
-                                          company_id=self.company_id,
-                                          role=self.get_role)
+            with transaction.atomic():
+                obj = Employee.objects.create(user=obj,
+                                              company_id=self.company_id,
+                                              role=self.get_role)
         except IntegrityError:
             obj = Employee.objects_all.get(user=obj, company_id=self.company_id)
             obj.is_deleted = False
@@ -97,7 +122,13 @@ class EmployeeForm(forms.ModelForm):
         return obj
 
 
-class UserForm(forms.ModelForm):
+class EmployeeImportForm(forms.Form):
+    file = forms.FileField(help_text="CSV with the columns: username, password, first_name, last_name, "
+                                     "phone_number, email, role (name or id). Existing users only need "
+                                     "username and role.")
+
+
+class UserForm(UniqueContactMixin, forms.ModelForm):
     username = forms.CharField(max_length=255)
     password = forms.CharField(widget=forms.PasswordInput(), required=False)
     phone_number = forms.CharField(max_length=13, required=False)
@@ -109,40 +140,31 @@ class UserForm(forms.ModelForm):
 
     def clean(self):
         super().clean()
-        profile_check = Profile.objects.filter(phone_number=self.cleaned_data['phone_number'])
-        email_check = User.objects.filter(email=self.cleaned_data['email'])
 
         for key in self.fields.keys():
-            if not self.cleaned_data[key]:
+            if not self.cleaned_data.get(key):
                 real_name = re.sub('_', ' ', key).capitalize()
                 raise forms.ValidationError({key: f'{real_name} can not be empty.'})
 
-        if profile_check.count():
-            raise_err = True
-            if self.instance:
-                raise_err = False
-                if profile_check.first().phone_number != self.instance.profile.phone_number:
-                    raise_err = True
+        taken = find_taken_fields(self.cleaned_data['username'], self.cleaned_data['email'],
+                                  self.cleaned_data['phone_number'], exclude=self.instance.pk)
 
-            if raise_err:
-                raise forms.ValidationError({'phone_number': 'Phone number is already in use!'})
+        if 'username' in taken:
+            raise forms.ValidationError({'username': 'Username is already in use!'})
 
-        if email_check.count():
-            raise_err2 = True
-            if self.instance:
-                raise_err2 = False
-                if email_check.first().email != self.instance.email:
-                    raise_err2 = True
+        if 'phone_number' in taken:
+            raise forms.ValidationError({'phone_number': 'Phone number is already in use!'})
 
-            if raise_err2:
-                raise forms.ValidationError({'email': 'Email is already in use!'})
+        if 'email' in taken:
+            raise forms.ValidationError({'email': 'Email is already in use!'})
 
         return self.cleaned_data
 
     def save(self, commit=True):
-        obj = super().save(commit=commit)
+        obj = super().save(commit=False)
         obj.set_password(self.cleaned_data['password'])
-        obj.profile.phone_number = self.cleaned_data['phone_number']
-        obj.profile.save()
         obj.save()
+        # New users get their profile row from the User post_save signal.
+        if not Profile.objects.filter(user=obj).update(phone_number=self.cleaned_data['phone_number']):
+            Profile.objects.create(user=obj, phone_number=self.cleaned_data['phone_number'])
         return obj
@@ -1,17 +1,249 @@
-from django.db import models
-from .utils import paginate
+from collections import namedtuple
+from functools import partial
+
+from asgiref.sync import sync_to_async
+
+from django.db import models, transaction, IntegrityError
+from django.db.models import Max
+from django.utils import timezone
+from .cache import uid_cache, MISSING
+from .exceptions import CustomError
+from .utils import paginate, paginate_counted, keyset_paginate
+from .summary import refresh_summaries, shift_days
+
+
+ResolvedEmployee = namedtuple('ResolvedEmployee', ('employee_id', 'company_id', 'active'))
 
 
 class DeletedManager(models.Manager):
+    """
+    Hides soft-deleted rows. ``select_related``, ``prefetch_related`` and ``only``
+    declare what the panel list templates read from each row, so that
+    ``get_paginated`` loads a page in a constant number of queries.
+    ``keyset`` (see ``keyset_paginate``) switches ``get_paginated`` to cursor
+    pagination unless the request explicitly asks for a ``page`` number.
+    """
+
+    def __init__(self, select_related=(), prefetch_related=(), only=(), keyset=None):
+        super().__init__()
+        self.list_select_related = select_related
+        self.list_prefetch_related = prefetch_related
+        self.list_only = only
+        self.keyset = keyset
+
     def get_queryset(self):
         return super().get_queryset().filter(is_deleted=False)
 
-    def get_paginated(self, request, **kwargs):
+    def for_list(self, select_related=None, prefetch_related=None, only=None):
+        obj = self.get_queryset()
+        select_related = self.list_select_related if select_related is None else select_related
+        prefetch_related = self.list_prefetch_related if prefetch_related is None else prefetch_related
+        only = self.list_only if only is None else only
+
+        if select_related:
+            obj = obj.select_related(*select_related)
+        if prefetch_related:
+            obj = obj.prefetch_related(*prefetch_related)
+        if only:
+            obj = obj.only(*only)
+        return obj
+
+    def get_paginated(self, request, select_related=None, prefetch_related=None, only=None, **kwargs):
+        obj = self.for_list(select_related, prefetch_related, only).filter(**kwargs)
+        if self.keyset and 'page' not in request.GET:
+            return keyset_paginate(request.GET.get('cursor'), obj, self.keyset), obj
+
         page = request.GET.get('page', 1)
-        obj = self.filter(**kwargs)
         return paginate(page, obj), obj
 
 
+class CompanyManager(DeletedManager):
+    def get_overview(self, request, user, membership):
+        """
+        The user's owned, employed and pending companies for the company list page.
+
+        Each list is one query that also carries its total through a window
+        count, so the page costs three queries however many memberships the
+        user has. Owned and employed companies come from the user's cached
+        membership ids; pending invitations are not part of it.
+        """
+        page = request.GET.get('page', 1)
+        lists = {
+            'owned': self.for_list().filter(id__in=membership.owned),
+            'employed': self.for_list().filter(id__in=membership.employed),
+            'pending': self.for_list().filter(employees__user=user, employees__is_deleted=False,
+                                              employees__is_accepted=False),
+        }
+        return {name: paginate_counted(page, obj) for name, obj in lists.items()}
+
+
 class EmployeeManager(DeletedManager):
     def get_queryset(self):
         return super().get_queryset().filter(is_accepted=True)
+
+    def resolve_uid(self, uid):
+        """
+        Map a badge uid to a ResolvedEmployee, or None when the uid is unknown.
+
+        Results, including misses, are served from the in-process uid cache,
+        which the Employee and Company signals in models.py invalidate.
+        """
+        resolved = uid_cache.get(uid)
+        if resolved is not MISSING:
+            return resolved
+
+        row = (self.model.objects_all.filter(uid=uid)
+               .values_list('id', 'company_id', 'is_deleted', 'is_accepted', 'company__is_deleted')
+               .first())
+        if row:
+            employee_id, company_id, is_deleted, is_accepted, company_deleted = row
+            resolved = ResolvedEmployee(employee_id, company_id, is_accepted and not is_deleted and not company_deleted)
+        else:
+            resolved = None
+
+        uid_cache.set(uid, resolved)
+        return resolved
+
+    async def aresolve_uid(self, uid):
+        resolved = uid_cache.get(uid)
+        if resolved is not MISSING:
+            return resolved
+
+        row = await (self.model.objects_all.filter(uid=uid)
+                     .values_list('id', 'company_id', 'is_deleted', 'is_accepted', 'company__is_deleted')
+                     .afirst())
+        if row:
+            employee_id, company_id, is_deleted, is_accepted, company_deleted = row
+            resolved = ResolvedEmployee(employee_id, company_id, is_accepted and not is_deleted and not company_deleted)
+        else:
+            resolved = None
+
+        uid_cache.set(uid, resolved)
+        return resolved
+
+
+class ShiftManager(DeletedManager):
+    early_punch_message = "The open shift starts after this punch; check the kiosk clock."
+
+    def toggle(self, employee_id, when=None):
+        """
+        Close the employee's open shift, or open a new one if there is none.
+
+        Runs two statements in one transaction: the open shift is read (and
+        locked) together with its enter time, then closed by pk or a new one
+        inserted. Closing also refreshes the shift's days in the daily summary
+        from that enter time, but only once the punch has committed: its read
+        and upsert run after the punch's transaction, and a failure there is
+        logged rather than failing the punch (``rebuild_shift_summary`` repairs it).
+        The partial unique constraint on open shifts makes a concurrent
+        double punch fail on INSERT instead of opening a second shift.
+        Returns True when a shift was opened and False when one was closed;
+        raises CustomError rather than close a shift before it started.
+        """
+        when = when or timezone.now()
+        try:
+            with transaction.atomic():
+                open_shift = (self.select_for_update().filter(employee_id=employee_id, exit_time=None)
+                              .values_list('pk', 'enter_time').first())
+                if open_shift and open_shift[1] and open_shift[1] > when:
+                    raise CustomError(self.early_punch_message)
+                # exit_time=None again: without row locks (SQLite) a concurrent punch may have closed it.
+                if open_shift and (self.filter(pk=open_shift[0], exit_time=None)
+                                   .update(exit_time=when, updated_at=timezone.now())):
+                    transaction.on_commit(partial(refresh_summaries, {employee_id: shift_days(open_shift[1], when)}),
+                                          robust=True)
+                    return False
+
+                self.create(employee_id=employee_id, enter_time=when)
+        except IntegrityError:
+            # Another punch opened the shift first; ours is a duplicate of it.
+            pass
+
+        return True
+
+    async def atoggle(self, employee_id, when=None):
+        """
+        Async counterpart of toggle for the ASGI punch views.
+
+        The async ORM cannot wrap both statements in one transaction, but each
+        statement is atomic on its own and the open-shift constraint still
+        rejects a second open shift, so the toggle stays race-free. Each
+        statement commits on its own, so the summary refresh after a close
+        already runs after the punch has committed.
+        """
+        when = when or timezone.now()
+        open_shift = await (self.filter(employee_id=employee_id, exit_time=None)
+                            .values_list('pk', 'enter_time').afirst())
+        if open_shift and open_shift[1] and open_shift[1] > when:
+            raise CustomError(self.early_punch_message)
+        if open_shift and await (self.filter(pk=open_shift[0], exit_time=None)
+                                 .aupdate(exit_time=when, updated_at=timezone.now())):
+            await sync_to_async(refresh_summaries)({employee_id: shift_days(open_shift[1], when)})
+            return False
+
+        try:
+            await self.acreate(employee_id=employee_id, enter_time=when)
+        except IntegrityError:
+            pass
+
+        return True
+
+    def apply_punches(self, punches):
+        """
+        Apply a backlog of (employee_id, when) punches in timestamp order.
+
+        Open shifts and each employee's latest punch are read in two queries,
+        the toggles are resolved in memory and written with bulk_update and
+        bulk_create. Punches not newer than the employee's latest recorded
+        punch are reported as duplicates, so replaying a backlog is harmless.
+        Returns one of 'started', 'ended' or 'duplicate' per punch, in input order.
+        """
+        results = [None] * len(punches)
+        employee_ids = {employee_id for employee_id, when in punches}
+        to_create, to_update = [], []
+        now = timezone.now()
+
+        with transaction.atomic():
+            open_shifts = {obj.employee_id: obj
+                           for obj in self.select_for_update().filter(employee_id__in=employee_ids, exit_time=None)}
+            latest = {}
+            last_times = (self.filter(employee_id__in=employee_ids).order_by().values('employee_id')
+                          .annotate(last_enter=Max('enter_time'), last_exit=Max('exit_time')))
+            for row in last_times:
+                times = [t for t in (row['last_enter'], row['last_exit']) if t]
+                if times:
+                    latest[row['employee_id']] = max(times)
+
+            for i in sorted(range(len(punches)), key=lambda i: punches[i][1]):
+                employee_id, when = punches[i]
+                # An open shift's enter_time is among the latest punches, so this also
+                # keeps a shift from being closed before it started.
+                if employee_id in latest and when <= latest[employee_id]:
+                    results[i] = 'duplicate'
+                    continue
+
+                obj = open_shifts.pop(employee_id, None)
+                if obj:
+                    obj.exit_time = when
+                    obj.updated_at = now
+                    if obj.pk:
+                        to_update.append(obj)
+                    results[i] = 'ended'
+                else:
+                    obj = self.model(employee_id=employee_id, enter_time=when)
+                    open_shifts[employee_id] = obj
+                    to_create.append(obj)
+                    results[i] = 'started'
+                latest[employee_id] = when
+
+            # Close existing shifts first so new open ones never clash with the constraint.
+            # bulk_update and update() skip auto_now, so updated_at is written explicitly.
+            self.bulk_update(to_update, ['exit_time', 'updated_at'])
+            self.bulk_create(to_create)
+
+            closed_days = {}
+            for obj in to_update + to_create:
+                closed_days.setdefault(obj.employee_id, set()).update(shift_days(obj.enter_time, obj.exit_time))
+            refresh_summaries(closed_days)
+
+        return results
@@ -0,0 +1,116 @@
+import hashlib
+import io
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import qrcode
+from qrcode.image.svg import SvgPathImage
+from django.conf import settings
+
+from .cache import LRUCache, MISSING
+
+try:
+    from qrcode.image.pil import PilImage as PngImage
+except ImportError:  # optional; without Pillow fall back to pypng, and without either PNG badges are off
+    from qrcode.compat.png import PngWriter
+    from qrcode.image.pure import PyPNGImage
+    PngImage = PyPNGImage if PngWriter else None
+
+PNG_AVAILABLE = PngImage is not None
+
+BADGE_CONTENT_TYPES = {'svg': 'image/svg+xml', 'png': 'image/png'}
+
+# Part of every badge digest: changing how badges are drawn must change this, so old files are not reused.
+BADGE_STYLE = 'L:10:4'
+
+
+# (digest, format) -> image bytes. Entries never go stale: a digest always names the same image.
+badge_cache = LRUCache(maxsize=getattr(settings, 'BADGE_CACHE_SIZE', 512))
+
+
+def badge_formats():
+    return [fmt for fmt in BADGE_CONTENT_TYPES if fmt != 'png' or PNG_AVAILABLE]
+
+
+def badge_root():
+    return Path(getattr(settings, 'BADGE_ROOT', None) or Path(settings.BASE_DIR) / 'badges')
+
+
+def badge_digest(uid):
+    """Content address of a badge: the same uid and BADGE_STYLE always give the same image."""
+    return hashlib.sha256(f'{BADGE_STYLE}:{uid}'.encode()).hexdigest()
+
+
+def badge_path(root, digest, fmt):
+    return Path(root) / digest[:2] / f'{digest}.{fmt}'
+
+
+def render_badge(uid, fmt):
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(uid)
+    qr.make(fit=True)
+
+    buffer = io.BytesIO()
+    qr.make_image(image_factory=PngImage if fmt == 'png' else SvgPathImage).save(buffer)
+    return buffer.getvalue()
+
+
+def store_badge(root, uid, fmt):
+    """
+    Render the badge into the disk tier unless it is already there; returns ``(content, created)``.
+
+    Files are written under a temporary name and renamed into place, so concurrent writers
+    and readers only ever see complete images.
+    """
+    path = badge_path(root, badge_digest(uid), fmt)
+    try:
+        return path.read_bytes(), False
+    except FileNotFoundError:
+        pass
+
+    content = render_badge(uid, fmt)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(content)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return content, True
+
+
+def get_badge(uid, fmt):
+    """``(digest, content)`` of a badge from memory, then disk, rendering it on first request."""
+    digest = badge_digest(uid)
+    content = badge_cache.get((digest, fmt))
+    if content is MISSING:
+        content = store_badge(badge_root(), uid, fmt)[0]
+        badge_cache.set((digest, fmt), content)
+    return digest, content
+
+
+def _store_badge(job):
+    # Runs in a pool worker; needs neither Django nor the database.
+    root, uid, fmt = job
+    return store_badge(root, uid, fmt)[1]
+
+
+def pregenerate_badges(uids, formats, workers=None):
+    """Write the missing badges of ``uids`` to the disk tier on a process pool; returns how many were created."""
+    root = badge_root()
+    jobs = [(root, uid, fmt) for uid in uids for fmt in formats]
+    workers = workers or getattr(settings, 'BADGE_WORKERS', None) or os.cpu_count() or 1
+    if workers == 1 or len(jobs) < 2:
+        return sum(map(_store_badge, jobs))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return sum(pool.map(_store_badge, jobs, chunksize=max(len(jobs) // (workers * 4), 1)))
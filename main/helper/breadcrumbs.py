@@ -0,0 +1,34 @@
+import re
+from functools import lru_cache
+
+
+PARAMETER = re.compile(r'<(?:\w+:)?(\w+)>')
+# Routes of re_path() patterns are regular expressions rather than path() templates.
+REGEX_ROUTE = re.compile(r'[\^$\\(\[]')
+
+
+def prefixes(parts):
+    """(name, url) of every leading run of ``parts``: panel, panel>company, panel>company>1, ..."""
+    return [('>'.join(parts[:i + 1]), '/' + '/'.join(parts[:i + 1]) + '/') for i in range(len(parts))]
+
+
+@lru_cache(maxsize=None)
+def route_breadcrumbs(route):
+    """
+    Breadcrumbs of a path() route such as ``panel/company/<int:pk>/edit`` as format strings,
+    e.g. ``('panel>company>{pk}', '/panel/company/{pk}/')``. Routes come from the URLconf,
+    so this is worked out once per route and only the parameters are filled in per request.
+    """
+    parts = [PARAMETER.sub(r'{\1}', part.replace('{', '{{').replace('}', '}}'))
+             for part in route.split('/') if part]
+    return tuple(prefixes(parts))
+
+
+def breadcrumbs(request):
+    """The panel sidebar's "Your Current Location" list for the request's resolved URL."""
+    match = request.resolver_match
+    if match is None or REGEX_ROUTE.search(match.route or '^'):
+        return [{'name': name, 'url': url} for name, url in prefixes([part for part in request.path.split('/') if part])]
+
+    return [{'name': name.format_map(match.kwargs), 'url': url.format_map(match.kwargs)}
+            for name, url in route_breadcrumbs(match.route)]
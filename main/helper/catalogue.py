@@ -0,0 +1,54 @@
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+
+
+class ReferenceCatalogue:
+    """
+    A small lookup table (roles and the like) kept as ``(id, name)`` rows in the default cache.
+
+    Nothing is read at import time: the rows are loaded on first use and then served from
+    the cache until a signal calls ``invalidate`` or CATALOGUE_CACHE_TTL runs out (the
+    latter bounds staleness for other processes when the cache is not shared).
+    """
+
+    def __init__(self, model_label, label_field='name'):
+        self.model_label = model_label
+        self.label_field = label_field
+        self.cache_key = f'catalogue:{model_label.lower()}'
+
+    @property
+    def model(self):
+        return apps.get_model(self.model_label)
+
+    def rows(self):
+        rows = cache.get(self.cache_key)
+        if rows is None:
+            rows = list(self.model.objects.values_list('pk', self.label_field))
+            cache.set(self.cache_key, rows, getattr(settings, 'CATALOGUE_CACHE_TTL', 300))
+        return rows
+
+    def choices(self):
+        """Callable choices for form and serializer fields."""
+        return self.rows()
+
+    def get(self, pk):
+        """An unsaved-looking instance carrying pk and label (enough to assign to a foreign key), or None."""
+        try:
+            pk = int(pk)
+        except (TypeError, ValueError):
+            return None
+
+        for row_pk, label in self.rows():
+            if row_pk == pk:
+                return self.model(pk=row_pk, **{self.label_field: label})
+        return None
+
+    def by_label(self):
+        return {label: self.model(pk=pk, **{self.label_field: label}) for pk, label in self.rows()}
+
+    def invalidate(self):
+        cache.delete(self.cache_key)
+
+
+role_catalogue = ReferenceCatalogue('main.Role')
@@ -0,0 +1,49 @@
+import hashlib
+
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+
+
+def is_versioned(model):
+    return any(field.name == 'updated_at' for field in model._meta.concrete_fields)
+
+
+def probe(queryset, *related):
+    """
+    ``(last updated_at, row count, last updated_at of each related)`` of ``queryset`` from one
+    aggregate query, without fetching rows.
+
+    The count catches rows that leave the scope (deletes, soft deletes, filters) without
+    touching a remaining row's ``updated_at``. ``related`` names the versioned relations the
+    page also renders (``'employee__company'``, ``'user__profile'`` for the user's names, ...),
+    so editing one of those changes the version as well.
+    """
+    aggregates = {'last': Max('updated_at'), 'total': Count('pk')}
+    aggregates.update((f'related_{i}', Max(f'{relation}__updated_at')) for i, relation in enumerate(related))
+    return tuple(queryset.order_by().aggregate(**aggregates).values())
+
+
+def conditional_response(request, versions, respond, *scope):
+    """
+    Answer 304 Not Modified when the client already holds the current ``versions`` (a list of
+    ``probe`` results); otherwise call ``respond()`` and tag its response with an ETag.
+
+    The ETag also covers the user, the query string and any extra ``scope`` values, so the same
+    URL rendered for another user or page never matches. There is no Last-Modified: the newest
+    ``updated_at`` left in scope can move backwards (a soft delete), so only the ETag is reliable.
+    """
+    parts = [request.user.pk, request.get_full_path(), *scope]
+    parts.extend(repr(version) for version in versions)
+    etag = quote_etag(hashlib.md5(repr(parts).encode()).hexdigest())
+
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = respond()
+        if response.status_code != 200:
+            return response
+
+    response['ETag'] = etag
+    # Polling clients must revalidate every time, and per-user pages must stay out of shared caches.
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
@@ -0,0 +1,68 @@
+import csv
+import tempfile
+
+from django.apps import apps
+from django.utils import timezone
+
+try:
+    from openpyxl import Workbook
+except ImportError:  # optional; only the XLSX export needs it
+    Workbook = None
+
+XLSX_AVAILABLE = Workbook is not None
+
+
+TIMESHEET_HEADER = ('Employee UID', 'Username', 'First name', 'Last name', 'Enter time', 'Exit time', 'Hours')
+
+
+class Echo:
+    """File-like object whose write() hands the line back, so csv.writer can feed a streaming response."""
+
+    def write(self, value):
+        return value
+
+
+def timesheet_rows(company_id, start, end, chunk_size=2000):
+    """
+    Yield the header and one row per shift of the company that started in [start, end).
+
+    Rows come from a single values_list query (the employee and user joins resolved in SQL)
+    read through a server-side iterator, so memory stays bounded whatever the range.
+    """
+    Shift = apps.get_model('main', 'Shift')
+    zone = timezone.get_default_timezone()
+
+    rows = (Shift.objects.filter(employee__company_id=company_id, enter_time__gte=start, enter_time__lt=end)
+            .order_by('employee_id', 'enter_time', 'id')
+            .values_list('employee__uid', 'employee__user__username', 'employee__user__first_name',
+                         'employee__user__last_name', 'enter_time', 'exit_time'))
+
+    yield TIMESHEET_HEADER
+    for uid, username, first_name, last_name, enter_time, exit_time in rows.iterator(chunk_size=chunk_size):
+        hours = round((exit_time - enter_time).total_seconds() / 3600, 2) if exit_time else ''
+        yield (uid, username, first_name, last_name,
+               timezone.localtime(enter_time, zone).strftime('%Y-%m-%d %H:%M'),
+               timezone.localtime(exit_time, zone).strftime('%Y-%m-%d %H:%M') if exit_time else '',
+               hours)
+
+
+def stream_csv(rows):
+    writer = csv.writer(Echo())
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def write_xlsx(rows):
+    """
+    Write ``rows`` into an XLSX file with openpyxl's write-only mode (rows are not kept in memory)
+    and return the file, rewound. XLSX is a zip archive, so it cannot be streamed while it is built.
+    """
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Timesheet')
+    for row in rows:
+        sheet.append(row)
+
+    output = tempfile.TemporaryFile()
+    workbook.save(output)
+    output.seek(0)
+    return output
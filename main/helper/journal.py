@@ -0,0 +1,177 @@
+import atexit
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+
+from django.apps import apps
+from django.conf import settings
+from django.db import close_old_connections
+
+try:
+    import fcntl
+except ImportError:  # no advisory locks (Windows): run a single process per journal there
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class PunchJournal:
+    """
+    Durable append-only log of punches kept in its own WAL-mode SQLite file.
+
+    Appending only touches the journal file, so kiosks are acknowledged
+    without waiting on write locks of the main database. Rows stay in the
+    journal until ``flush`` has applied them to ``Shift``; replaying rows that
+    were applied right before a crash is harmless because
+    ``ShiftManager.apply_punches`` skips punches it has already recorded.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=FULL')
+            conn.execute('CREATE TABLE IF NOT EXISTS punch ('
+                         'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'employee_id INTEGER NOT NULL, '
+                         'punched_at TEXT NOT NULL)')
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def append(self, employee_id, when):
+        conn = self._connection()
+        with conn:
+            conn.execute('INSERT INTO punch (employee_id, punched_at) VALUES (?, ?)',
+                         (employee_id, when.isoformat()))
+
+    def pending(self, limit):
+        rows = self._connection().execute(
+            'SELECT seq, employee_id, punched_at FROM punch ORDER BY seq LIMIT ?', (limit, ))
+        return [(seq, employee_id, datetime.fromisoformat(punched_at)) for seq, employee_id, punched_at in rows]
+
+    def discard(self, last_seq):
+        conn = self._connection()
+        with conn:
+            conn.execute('DELETE FROM punch WHERE seq <= ?', (last_seq, ))
+
+    def flush(self, batch_size=500):
+        """Apply journaled punches to Shift in batched transactions; returns how many were applied."""
+        Shift = apps.get_model('main', 'Shift')
+        Employee = apps.get_model('main', 'Employee')
+        applied = 0
+
+        while True:
+            rows = self.pending(batch_size)
+            if not rows:
+                return applied
+
+            employee_ids = set(Employee.objects_all.filter(id__in={row[1] for row in rows})
+                               .values_list('id', flat=True))
+            punches = [(employee_id, when) for seq, employee_id, when in rows if employee_id in employee_ids]
+            if len(punches) != len(rows):
+                logger.warning("Dropping %d journaled punches of removed employees.", len(rows) - len(punches))
+
+            Shift.objects.apply_punches(punches)
+            self.discard(rows[-1][0])
+            applied += len(punches)
+
+
+class FlushLock:
+    """
+    Exclusive advisory lock on ``<journal>.lock``. Only one process may flush a given journal,
+    since two flushers would apply the same rows twice; every process may append to it.
+    The lock is released when its holder exits, so another process takes over its flushing.
+    """
+
+    def __init__(self, path):
+        self.path = f'{path}.lock'
+        self.file = None
+
+    def acquire(self):
+        if self.file is not None or fcntl is None:
+            return True
+
+        file = open(self.path, 'a')
+        try:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            file.close()
+            return False
+
+        self.file = file
+        return True
+
+    def release(self):
+        if self.file is not None:
+            # Closing the file drops the lock.
+            self.file.close()
+            self.file = None
+
+
+class JournalFlusher(threading.Thread):
+    def __init__(self, journal, interval, batch_size):
+        super().__init__(name='punch-journal-flusher', daemon=True)
+        self.journal = journal
+        self.interval = interval
+        self.batch_size = batch_size
+        self.lock = FlushLock(journal.path)
+        self.stopped = threading.Event()
+
+    def run(self):
+        # The first pass replays whatever a previous process left in the journal. Processes
+        # that do not hold the flush lock only append, and retry the lock every interval.
+        while True:
+            close_old_connections()
+            try:
+                if self.lock.acquire():
+                    self.journal.flush(self.batch_size)
+            except Exception:
+                logger.exception("Flushing the punch journal failed, retrying in %ss.", self.interval)
+
+            if self.stopped.wait(self.interval):
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        if self.lock.acquire():
+            self.journal.flush(self.batch_size)
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def get_punch_journal():
+    """
+    Return the process-wide journal, starting its flusher, or None when PUNCH_JOURNAL is unset.
+    The WSGI and ASGI entry points call this at startup, so punches left by a crashed process are
+    replayed without waiting for the next punch. Nothing else does: migrate and the other management
+    commands never start a flusher, unless they punch themselves.
+    """
+    global _journal
+
+    path = getattr(settings, 'PUNCH_JOURNAL', None)
+    if not path:
+        return None
+
+    if _journal is None:
+        with _journal_lock:
+            if _journal is None:
+                journal = PunchJournal(path)
+                flusher = JournalFlusher(journal,
+                                         getattr(settings, 'PUNCH_JOURNAL_FLUSH_INTERVAL', 1.0),
+                                         getattr(settings, 'PUNCH_JOURNAL_BATCH_SIZE', 500))
+                flusher.start()
+                atexit.register(flusher.stop)
+                _journal = journal
+
+    return _journal
@@ -0,0 +1,85 @@
+from collections import namedtuple
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models import Value
+
+
+Membership = namedtuple('Membership', ('owned', 'employed'))
+
+EMPTY_MEMBERSHIP = Membership(frozenset(), frozenset())
+GENERATION_KEY = 'membership:generation'
+
+
+def _ttl():
+    return getattr(settings, 'MEMBERSHIP_CACHE_TTL', 300)
+
+
+def _generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, 1, None)
+        generation = cache.get(GENERATION_KEY, 1)
+    return generation
+
+
+def _cache_key(user_id):
+    return f'membership:{_generation()}:{user_id}'
+
+
+def compute_membership(user_id):
+    """Ids of the live companies the user owns and is an accepted employee of, in one query."""
+    Company = apps.get_model('main', 'Company')
+    Employee = apps.get_model('main', 'Employee')
+
+    owned = Company.objects.filter(created_by_id=user_id).values_list('id', Value(True))
+    employed = (Employee.objects.filter(user_id=user_id, company__is_deleted=False)
+                .values_list('company_id', Value(False)))
+
+    rows = list(owned.order_by().union(employed.order_by(), all=True))
+    return Membership(frozenset(company_id for company_id, is_owner in rows if is_owner),
+                      frozenset(company_id for company_id, is_owner in rows if not is_owner))
+
+
+def shared_cache():
+    """
+    Memberships decide access, so they may only be kept across requests in a cache every worker
+    shares: an invalidation in a process-local cache would not reach the other workers.
+    """
+    return bool(_ttl()) and not isinstance(caches['default'], LocMemCache)
+
+
+def get_user_membership(user_id):
+    if not shared_cache():
+        return compute_membership(user_id)
+
+    key = _cache_key(user_id)
+    membership = cache.get(key)
+    if membership is None:
+        membership = compute_membership(user_id)
+        cache.set(key, membership, _ttl())
+    return membership
+
+
+def get_membership(request):
+    """The request user's Membership, computed once per request and, with a shared cache, across requests."""
+    membership = getattr(request, '_membership', None)
+    if membership is None:
+        user = request.user
+        membership = get_user_membership(user.id) if user.is_authenticated else EMPTY_MEMBERSHIP
+        request._membership = membership
+    return membership
+
+
+def invalidate_membership(user_id):
+    cache.delete(_cache_key(user_id))
+
+
+def invalidate_all_memberships():
+    """Company changes can touch every member's view, so start a new cache generation."""
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.add(GENERATION_KEY, 1, None)
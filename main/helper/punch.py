@@ -0,0 +1,82 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+PENDING = 'pending'
+
+
+def _debounce_key(employee_id):
+    return f'punch:debounce:{employee_id}'
+
+
+def _debounce_window():
+    return getattr(settings, 'PUNCH_DEBOUNCE_SECONDS', 0)
+
+
+def claim_punch(employee_id):
+    """
+    Reserve the employee's debounce window.
+
+    Returns None when the punch should go ahead, otherwise the message of the
+    punch it duplicates, so repeated scans never reach the Shift table.
+    """
+    window = _debounce_window()
+    if not window or cache.add(_debounce_key(employee_id), PENDING, window):
+        return None
+    previous = cache.get(_debounce_key(employee_id))
+    return previous if previous and previous != PENDING else "Punch already recorded."
+
+
+def remember_punch(employee_id, result):
+    window = _debounce_window()
+    if window:
+        cache.set(_debounce_key(employee_id), result, window)
+
+
+def release_punch(employee_id):
+    """Give up a claimed window whose punch failed, so the next scan is not absorbed as its duplicate."""
+    if _debounce_window():
+        cache.delete(_debounce_key(employee_id))
+
+
+async def aclaim_punch(employee_id):
+    window = _debounce_window()
+    if not window or await cache.aadd(_debounce_key(employee_id), PENDING, window):
+        return None
+    previous = await cache.aget(_debounce_key(employee_id))
+    return previous if previous and previous != PENDING else "Punch already recorded."
+
+
+async def aremember_punch(employee_id, result):
+    window = _debounce_window()
+    if window:
+        await cache.aset(_debounce_key(employee_id), result, window)
+
+
+async def arelease_punch(employee_id):
+    if _debounce_window():
+        await cache.adelete(_debounce_key(employee_id))
+
+
+def idempotency_key(request):
+    """The request's ``Idempotency-Key`` header (or ``idempotency_key`` param), if any."""
+    return request.headers.get('Idempotency-Key') or request.GET.get('idempotency_key')
+
+
+def idempotency_cache_key(request, user):
+    """
+    Cache key of the request's idempotency key, or None without one. It is scoped by the user and
+    by the badge uid and company punched, so another caller reusing a key never gets our response.
+    """
+    key = idempotency_key(request)
+    if not key:
+        return None
+    scope = (request.path, user.pk, request.GET.get('uid'), request.GET.get('company_id'), key)
+    digest = hashlib.sha256(repr(scope).encode()).hexdigest()
+    return f'punch:idempotency:{digest}'
+
+
+def idempotency_ttl():
+    return getattr(settings, 'PUNCH_IDEMPOTENCY_TTL', 24 * 60 * 60)
@@ -0,0 +1,157 @@
+import re
+
+from django.apps import apps
+from django.db import connection
+from django.db.models import CharField, Lookup, Q
+from django.db.models.expressions import RawSQL
+
+
+# Searchable documents: kind -> (model, text fields). Each kind gets its own FTS5 table on SQLite
+# whose rowid is the object's primary key, so updates and lookups never scan the index.
+DOCUMENTS = {
+    'user': ('auth.User', ('username', 'email', 'first_name', 'last_name')),
+    'company': ('main.Company', ('name', 'city')),
+}
+
+_available = {}
+
+
+@CharField.register_lookup
+class Prefix(Lookup):
+    """
+    ``field__prefix=value`` as a range (``field >= value AND field < value + U+10FFFF``).
+
+    Unlike ``startswith`` (``LIKE 'value%'``), a range can be answered by an ordinary
+    B-tree index on every backend, independent of LIKE case sensitivity. It is therefore
+    case-sensitive everywhere: ``city__prefix='teh'`` does not match "Tehran", where the
+    old ``__contains`` filters did on SQLite. Use ``search_filter`` for case-insensitive words.
+    """
+    lookup_name = 'prefix'
+    prepare_rhs = False
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        value = str(self.rhs)
+        return f'({lhs} >= %s AND {lhs} < %s)', [*lhs_params, value, *lhs_params, value + '\U0010ffff']
+
+
+def table_name(kind):
+    return f'main_search_{kind}'
+
+
+def fts_supported(conn=connection):
+    """True when the database is SQLite and the FTS5 tables created by the migrations exist."""
+    if conn.vendor != 'sqlite':
+        return False
+
+    if not _available.get(conn.alias):
+        # Only a positive answer is remembered: the tables appear once migrate has run.
+        tables = {table_name(kind) for kind in DOCUMENTS}
+        _available[conn.alias] = tables <= set(conn.introspection.table_names())
+    return _available[conn.alias]
+
+
+def document_body(values):
+    return ' '.join(str(value) for value in values if value)
+
+
+def tokens(term):
+    return re.findall(r'\w+', term or '')
+
+
+def index_document(kind, instance):
+    if not fts_supported():
+        return
+
+    _model, fields = DOCUMENTS[kind]
+    body = document_body(getattr(instance, field) for field in fields)
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {table_name(kind)} WHERE rowid = %s', [instance.pk])
+        cursor.execute(f'INSERT INTO {table_name(kind)} (rowid, body) VALUES (%s, %s)', [instance.pk, body])
+
+
+def index_documents(kind, instances):
+    """Bulk ``index_document`` for objects written without signals (bulk_create); they must be new."""
+    if not fts_supported():
+        return
+
+    _model, fields = DOCUMENTS[kind]
+    rows = [(instance.pk, document_body(getattr(instance, field) for field in fields)) for instance in instances]
+    with connection.cursor() as cursor:
+        cursor.executemany(f'INSERT INTO {table_name(kind)} (rowid, body) VALUES (%s, %s)', rows)
+
+
+def remove_document(kind, object_id):
+    if not fts_supported():
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {table_name(kind)} WHERE rowid = %s', [object_id])
+
+
+def rebuild_index(kind, batch_size=2000):
+    """Re-index every object of ``kind``; needed after writes that skip signals (bulk_create, update)."""
+    if not fts_supported():
+        return 0
+
+    model_label, fields = DOCUMENTS[kind]
+    rows = apps.get_model(model_label)._base_manager.values_list('pk', *fields).order_by().iterator(batch_size)
+    count = 0
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {table_name(kind)}')
+        batch = []
+        for pk, *values in rows:
+            batch.append((pk, document_body(values)))
+            if len(batch) >= batch_size:
+                cursor.executemany(f'INSERT INTO {table_name(kind)} (rowid, body) VALUES (%s, %s)', batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            cursor.executemany(f'INSERT INTO {table_name(kind)} (rowid, body) VALUES (%s, %s)', batch)
+            count += len(batch)
+    return count
+
+
+def search_filter(kind, relation, term):
+    """
+    Q matching objects whose ``kind`` document (reached through ``relation``) contains every
+    word of ``term`` as a word prefix.
+
+    On SQLite this is a single ``pk IN (SELECT rowid ... MATCH ...)`` against the FTS5 index.
+    Elsewhere each word becomes an ``icontains`` over the document fields, which PostgreSQL
+    answers from the trigram indexes added by the same migration.
+    """
+    words = tokens(term)
+    if not words:
+        return Q()
+
+    prefix = f'{relation}__' if relation else ''
+    if fts_supported():
+        match = ' '.join(f'"{word}"*' for word in words)
+        ids = RawSQL(f'SELECT rowid FROM {table_name(kind)} WHERE {table_name(kind)} MATCH %s', (match, ))
+        return Q(**{f'{prefix}pk__in': ids})
+
+    _model, fields = DOCUMENTS[kind]
+    query = Q()
+    for word in words:
+        word_query = Q()
+        for field in fields:
+            word_query |= Q(**{f'{prefix}{field}__icontains': word})
+        query &= word_query
+    return query
+
+
+def sync_user_document(sender, instance, **kwargs):
+    index_document('user', instance)
+
+
+def sync_company_document(sender, instance, **kwargs):
+    index_document('company', instance)
+
+
+def drop_user_document(sender, instance, **kwargs):
+    remove_document('user', instance.pk)
+
+
+def drop_company_document(sender, instance, **kwargs):
+    remove_document('company', instance.pk)
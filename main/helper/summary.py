@@ -0,0 +1,105 @@
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+from django.apps import apps
+from django.db.models import Q
+from django.utils import timezone
+
+
+def day_bounds(day):
+    """Aware [start, end) of a local calendar day in settings.TIME_ZONE."""
+    zone = timezone.get_default_timezone()
+    start = timezone.make_aware(datetime.combine(day, time.min), zone)
+    end = timezone.make_aware(datetime.combine(day + timedelta(days=1), time.min), zone)
+    return start, end
+
+
+def split_by_day(enter_time, exit_time):
+    """Yield ``(local date, seconds)`` for each local day the interval [enter_time, exit_time) covers."""
+    zone = timezone.get_default_timezone()
+    day = timezone.localtime(enter_time, zone).date()
+    start = enter_time
+    while start < exit_time:
+        day_end = day_bounds(day)[1]
+        end = min(day_end, exit_time)
+        yield day, (end - start).total_seconds()
+        day, start = day + timedelta(days=1), end
+
+
+def shift_days(enter_time, exit_time):
+    """Local dates a closed shift contributes to; an open or unstarted shift contributes nothing."""
+    if not enter_time or not exit_time:
+        return set()
+    return {day for day, seconds in split_by_day(enter_time, exit_time)}
+
+
+def refresh_summaries(days_by_employee):
+    """
+    Recompute the ShiftDailySummary rows of the given ``{employee_id: {local date, ...}}``
+    from the employees' closed shifts around those days, and upsert them.
+
+    Recomputing instead of adding deltas keeps the table correct after edits and deletes;
+    the read uses the per-employee shift index and touches only the affected days. It costs
+    one read and one upsert, plus a delete only when a day lost its last shift.
+    """
+    days_by_employee = {employee_id: days for employee_id, days in days_by_employee.items() if days}
+    if not days_by_employee:
+        return
+
+    Shift = apps.get_model('main', 'Shift')
+    ShiftDailySummary = apps.get_model('main', 'ShiftDailySummary')
+
+    overlapping = Q()
+    for employee_id, days in days_by_employee.items():
+        start, end = day_bounds(min(days))[0], day_bounds(max(days))[1]
+        overlapping |= Q(employee_id=employee_id, enter_time__lt=end, exit_time__gt=start)
+
+    totals = defaultdict(lambda: [0, 0])
+    companies = {}
+    rows = (Shift.objects.filter(overlapping).order_by()
+            .values_list('employee_id', 'employee__company_id', 'enter_time', 'exit_time'))
+    for employee_id, company_id, enter_time, exit_time in rows:
+        companies[employee_id] = company_id
+        for day, seconds in split_by_day(enter_time, exit_time):
+            if day in days_by_employee[employee_id]:
+                total = totals[employee_id, day]
+                total[0] += seconds
+                total[1] += 1
+
+    summaries = [ShiftDailySummary(employee_id=employee_id, company_id=companies[employee_id], date=day,
+                                   seconds=round(seconds), shifts=shifts)
+                 for (employee_id, day), (seconds, shifts) in totals.items()]
+    ShiftDailySummary.objects.bulk_create(summaries, update_conflicts=True,
+                                          unique_fields=('employee', 'company', 'date'),
+                                          update_fields=('seconds', 'shifts'))
+
+    emptied = Q()
+    for employee_id, days in days_by_employee.items():
+        days = [day for day in days if (employee_id, day) not in totals]
+        if days:
+            emptied |= Q(employee_id=employee_id, date__in=days)
+    if emptied:
+        ShiftDailySummary.objects.filter(emptied).delete()
+
+
+def rebuild_summaries(batch_size=2000):
+    """Rebuild the whole ShiftDailySummary table from the Shift table; returns the number of rows written."""
+    Shift = apps.get_model('main', 'Shift')
+    ShiftDailySummary = apps.get_model('main', 'ShiftDailySummary')
+
+    totals = defaultdict(lambda: [0, 0])
+    rows = (Shift._base_manager.filter(is_deleted=False, enter_time__isnull=False, exit_time__isnull=False)
+            .order_by().values_list('employee_id', 'employee__company_id', 'enter_time', 'exit_time'))
+    for employee_id, company_id, enter_time, exit_time in rows.iterator(batch_size):
+        for day, seconds in split_by_day(enter_time, exit_time):
+            total = totals[employee_id, company_id, day]
+            total[0] += seconds
+            total[1] += 1
+
+    ShiftDailySummary._base_manager.all().delete()
+    ShiftDailySummary._base_manager.bulk_create(
+        (ShiftDailySummary(employee_id=employee_id, company_id=company_id, date=day,
+                           seconds=round(seconds), shifts=shifts)
+         for (employee_id, company_id, day), (seconds, shifts) in totals.items()),
+        batch_size=batch_size)
+    return len(totals)
@@ -0,0 +1,70 @@
+import re
+
+from django.apps import apps
+from django.db.models import Q
+
+
+UNIQUE_FIELDS = ('username', 'email', 'phone_number')
+
+
+def normalize_email(email):
+    """Emails are stored lower-cased and stripped, so uniqueness is a plain indexed equality."""
+    return (email or '').strip().lower()
+
+
+def normalize_phone(phone_number):
+    """Digits with an optional leading '+'; separators are dropped and empty numbers become None."""
+    phone_number = re.sub(r'[\s\-().]', '', phone_number or '')
+    return phone_number or None
+
+
+def conflicting_users(username=None, email=None, phone_number=None, exclude=None):
+    """Users (with their profiles) holding any of the given values, read in one query."""
+    User = apps.get_model('auth', 'User')
+
+    query = Q()
+    if username:
+        query |= Q(username=username)
+    if email:
+        query |= Q(email=normalize_email(email))
+    if phone_number:
+        query |= Q(profile__phone_number=normalize_phone(phone_number))
+    if not query:
+        return []
+
+    users = User.objects.filter(query).select_related('profile')
+    if exclude is not None:
+        users = users.exclude(pk=exclude)
+    return list(users)
+
+
+def taken_fields(users, username=None, email=None, phone_number=None):
+    """Which of username/email/phone_number the ``conflicting_users`` result already uses."""
+    email, phone_number = normalize_email(email), normalize_phone(phone_number)
+    taken = set()
+    for user in users:
+        profile = getattr(user, 'profile', None)
+        if username and user.username == username:
+            taken.add('username')
+        if email and user.email == email:
+            taken.add('email')
+        if phone_number and profile and profile.phone_number == phone_number:
+            taken.add('phone_number')
+    return taken
+
+
+def find_taken_fields(username=None, email=None, phone_number=None, exclude=None):
+    users = conflicting_users(username, email, phone_number, exclude)
+    return taken_fields(users, username, email, phone_number)
+
+
+def integrity_error_field(error):
+    """
+    The unique field named by an IntegrityError raised when a concurrent write won the race
+    between the check above and our INSERT/UPDATE, or None if it is not one of them.
+    """
+    message = str(error)
+    for field in UNIQUE_FIELDS:
+        if field in message:
+            return field
+    return None
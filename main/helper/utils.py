@@ -1,4 +1,8 @@
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator, Page, EmptyPage, PageNotAnInteger
+from django.db.models import F, Q, Count, Window
+import base64
+import json
 import random
 
 
@@ -14,7 +18,139 @@ def paginate(page_num, obj):
     return paginated_obj
 
 
+def paginate_counted(page_num, obj, per_page=30):
+    """
+    Like ``paginate``, but the total comes from a ``COUNT(*) OVER ()`` column of
+    the page query itself, so a page with its count costs one query instead of two.
+    """
+    try:
+        number = max(int(page_num), 1)
+    except (TypeError, ValueError):
+        number = 1
+
+    counted = obj.annotate(window_total=Window(Count('*')))
+    rows = list(counted[(number - 1) * per_page:number * per_page])
+    if not rows and number > 1:
+        # Past the last page: fall back to it, as paginate() does.
+        total = obj.count()
+        number = max((total + per_page - 1) // per_page, 1)
+        rows = list(counted[(number - 1) * per_page:number * per_page])
+
+    paginator = Paginator(obj, per_page)
+    paginator.count = rows[0].window_total if rows else 0
+    return Page(rows, number, paginator)
+
+
 def generate_rand_string():
     _str = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
     rand_str = ''.join([random.choice(_str) for _ in range(15)])
     return rand_str
+
+
+class KeysetPage:
+    """One page of a keyset-paginated queryset; iterates like a Paginator page."""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+def _order_by(name, descending, nulls_first):
+    expression = F(name).desc if descending else F(name).asc
+    if nulls_first is None:
+        return expression()
+    return expression(nulls_first=True) if nulls_first else expression(nulls_last=True)
+
+
+def keyset_ordering(keys):
+    return [_order_by(*key) for key in keys]
+
+
+def _after(keys, values):
+    """Rows strictly after ``values`` in the order described by ``keys``."""
+    condition, equal = Q(pk__in=[]), Q()
+    for (name, descending, nulls_first), value in zip(keys, values):
+        if value is None:
+            after = Q(**{f'{name}__isnull': False}) if nulls_first else None
+            same = Q(**{f'{name}__isnull': True})
+        else:
+            after = Q(**{f'{name}__lt' if descending else f'{name}__gt': value})
+            if nulls_first is False:
+                after |= Q(**{f'{name}__isnull': True})
+            same = Q(**{name: value})
+
+        if after is not None:
+            condition |= equal & after
+        equal &= same
+    return condition
+
+
+def _encode_cursor(direction, values):
+    raw = json.dumps([direction, [v.isoformat() if hasattr(v, 'isoformat') else v for v in values]])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def _decode_cursor(cursor, fields):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        direction, values = json.loads(raw)
+        if direction not in ('next', 'prev') or len(values) != len(fields):
+            raise ValueError(cursor)
+        return direction, [None if v is None else field.to_python(v) for field, v in zip(fields, values)]
+    except (ValueError, TypeError, ValidationError):
+        return 'next', None
+
+
+def keyset_paginate(cursor, obj, keys, per_page=30):
+    """
+    Paginate ``obj`` by keyset instead of COUNT/OFFSET, so every page costs one query.
+
+    ``keys`` is a sequence of ``(field, descending, nulls_first)`` that totally
+    orders the rows (end it with the primary key); ``nulls_first`` is None for
+    columns that are never null. ``cursor`` is an opaque token produced by a
+    previous page, or None (or garbage) for the first page.
+    """
+    fields = [obj.model._meta.get_field(name) for name, descending, nulls_first in keys]
+    direction, values = _decode_cursor(cursor, fields) if cursor else ('next', None)
+    backwards = direction == 'prev'
+    if backwards:
+        keys_in_order = [(name, not descending, None if nulls_first is None else not nulls_first)
+                         for name, descending, nulls_first in keys]
+    else:
+        keys_in_order = list(keys)
+
+    obj = obj.order_by(*keyset_ordering(keys_in_order))
+    if values is not None:
+        obj = obj.filter(_after(keys_in_order, values))
+
+    rows = list(obj[:per_page + 1])
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    has_next = True if backwards else more
+    has_previous = more if backwards else values is not None
+    attnames = [field.attname for field in fields]
+
+    def key_of(row):
+        if isinstance(row, dict):  # values() querysets
+            return [row[attname] for attname in attnames]
+        return [getattr(row, attname) for attname in attnames]
+
+    return KeysetPage(rows,
+                      next_cursor=_encode_cursor('next', key_of(rows[-1])) if rows and has_next else None,
+                      previous_cursor=_encode_cursor('prev', key_of(rows[0])) if rows and has_previous else None)
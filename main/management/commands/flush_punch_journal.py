@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from main.helper.journal import FlushLock, PunchJournal
+
+
+class Command(BaseCommand):
+    help = "Apply every punch waiting in the PUNCH_JOURNAL file to the Shift table."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help="Journal file to replay (defaults to settings.PUNCH_JOURNAL).")
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'PUNCH_JOURNAL_BATCH_SIZE', 500))
+
+    def handle(self, *args, **options):
+        path = options['path'] or getattr(settings, 'PUNCH_JOURNAL', None)
+        if not path:
+            raise CommandError("No journal configured; set PUNCH_JOURNAL or pass --path.")
+
+        # A running server may be flushing the same journal; two flushers would apply its rows twice.
+        lock = FlushLock(path)
+        if not lock.acquire():
+            raise CommandError(f"Another process is flushing {path}; it applies the journal on its own.")
+
+        try:
+            applied = PunchJournal(path).flush(options['batch_size'])
+        finally:
+            lock.release()
+        self.stdout.write(self.style.SUCCESS(f"Applied {applied} journaled punches."))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from main.helper.badge import badge_formats, pregenerate_badges
+from main.models import Company, Employee
+
+
+class Command(BaseCommand):
+    help = "Pre-generate the QR badges of every employee of the given companies (default: all) into the disk cache."
+
+    def add_arguments(self, parser):
+        parser.add_argument('companies', nargs='*', type=int, help="Company ids (default: all companies).")
+        parser.add_argument('--format', dest='formats', action='append',
+                            help=f"Badge format, repeatable: {', '.join(badge_formats())} (default: all).")
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Worker processes (default: BADGE_WORKERS, or one per CPU).")
+
+    def handle(self, *args, **options):
+        formats = options['formats'] or badge_formats()
+        unknown = set(formats) - set(badge_formats())
+        if unknown:
+            raise CommandError(f"Unavailable badge formats: {', '.join(sorted(unknown))}.")
+
+        employees = Employee.objects.all()
+        if options['companies']:
+            missing = set(options['companies']) - set(Company.objects.filter(id__in=options['companies'])
+                                                      .values_list('id', flat=True))
+            if missing:
+                raise CommandError(f"Unknown companies: {', '.join(map(str, sorted(missing)))}.")
+            employees = employees.filter(company_id__in=options['companies'])
+
+        uids = list(employees.values_list('uid', flat=True).distinct())
+        created = pregenerate_badges(uids, formats, options['workers'])
+        cached = len(uids) * len(formats) - created
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated {created} badges for {len(uids)} employees; {cached} were already cached."))
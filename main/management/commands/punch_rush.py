@@ -0,0 +1,196 @@
+import asyncio
+import random
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.parse import urlencode, urlsplit
+from urllib.request import urlopen
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, close_old_connections
+from django.db.models import Count
+from django.conf import settings
+from django.test import Client, AsyncClient, override_settings
+from django.utils import timezone
+
+from main.models import Company, Role, Employee, Shift
+from main.helper.cache import uid_cache
+
+
+PUNCH_PATH = '/api/shift/add'
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+class Command(BaseCommand):
+    help = ("Seed employees and fire a burst of concurrent api/shift/add punches, then report throughput, "
+            "latency percentiles, lock errors and duplicate open shifts. Writes to the configured database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--employees', type=int, default=100)
+        parser.add_argument('--punches', type=int, default=1000)
+        parser.add_argument('--concurrency', type=int, default=20)
+        parser.add_argument('--mode', choices=('threads', 'asyncio'), default='threads')
+        parser.add_argument('--url', help="Base URL of a running server, e.g. http://127.0.0.1:8000. "
+                                          "Without it the in-process test client is used.")
+        parser.add_argument('--duplicate-ratio', type=float, default=0.1,
+                            help="Share of punches immediately re-fired, as a badge reader double scan would.")
+        parser.add_argument('--prefix', default='rush', help="Prefix of the seeded users, company and uids.")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed for a reproducible punch mix.")
+        parser.add_argument('--cleanup', action='store_true', help="Delete the rows this run created afterwards.")
+
+    def handle(self, *args, **options):
+        if options['employees'] < 1 or options['punches'] < 1 or options['concurrency'] < 1:
+            raise CommandError("--employees, --punches and --concurrency must be positive.")
+
+        prefix = options['prefix']
+        uids, seeded = self.seed(prefix, options['employees'])
+        plan = self.plan(uids, options['punches'], options['duplicate_ratio'], options['seed'])
+
+        self.stdout.write(f"Firing {len(plan)} punches for {len(uids)} employees "
+                          f"({options['mode']}, concurrency {options['concurrency']})...")
+        # The in-process test clients always send Host: testserver.
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            started = time.perf_counter()
+            if options['mode'] == 'threads':
+                samples = self.run_threads(plan, options['concurrency'], options['url'])
+            else:
+                samples = asyncio.run(self.run_asyncio(plan, options['concurrency'], options['url']))
+            elapsed = time.perf_counter() - started
+
+        self.report(samples, elapsed, prefix, in_process=not options['url'])
+
+        if options['cleanup']:
+            self.cleanup(seeded)
+
+    def seed(self, prefix, count):
+        """
+        Create what the run needs and reuse what a previous run left behind. Returns the uids and
+        the ids of the rows created by this call, the only ones ``cleanup`` deletes.
+        """
+        seeded = {'users': [], 'employees': [], 'companies': [], 'roles': []}
+
+        owner, created = User.objects.get_or_create(username=f'{prefix}_owner')
+        if created:
+            seeded['users'].append(owner.id)
+        role, created = Role.objects.get_or_create(name=f'{prefix}-role')
+        if created:
+            seeded['roles'].append(role.id)
+        company = Company.objects_all.filter(name=f'{prefix}-company').first()
+        if not company:
+            number = (Company.objects_all.order_by('-number').values_list('number', flat=True).first() or 0) + 1
+            company = Company.objects.create(name=f'{prefix}-company', number=number, city=prefix,
+                                             foundation_date=timezone.now().date(), created_by=owner)
+            seeded['companies'].append(company.id)
+
+        usernames = [f'{prefix}_{i}' for i in range(count)]
+        existing = set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+        new_names = [name for name in usernames if name not in existing]
+        User.objects.bulk_create([User(username=name) for name in new_names])
+        seeded['users'].extend(User.objects.filter(username__in=new_names).values_list('id', flat=True))
+        users = dict(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+
+        uids = [f'{prefix}{i:06d}' for i in range(count)]
+        existing = set(Employee.objects_all.filter(uid__in=uids).values_list('uid', flat=True))
+        new_uids = [uid for uid in uids if uid not in existing]
+        Employee.objects_all.bulk_create([
+            Employee(uid=uid, user_id=users[name], company=company, role=role, is_accepted=True)
+            for uid, name in zip(uids, usernames) if uid not in existing
+        ])
+        seeded['employees'].extend(Employee.objects_all.filter(uid__in=new_uids).values_list('id', flat=True))
+        return uids, seeded
+
+    def cleanup(self, seeded):
+        # Employees take their shifts with them; companies and users go last, as employees refer to them.
+        Employee.objects_all.filter(id__in=seeded['employees']).delete()
+        Company.objects_all.filter(id__in=seeded['companies']).delete()
+        Role.objects_all.filter(id__in=seeded['roles']).delete()
+        User.objects.filter(id__in=seeded['users']).delete()
+
+    def plan(self, uids, punches, duplicate_ratio, seed):
+        rand = random.Random(seed)
+        plan = []
+        while len(plan) < punches:
+            uid = rand.choice(uids)
+            plan.append(uid)
+            if rand.random() < duplicate_ratio and len(plan) < punches:
+                plan.append(uid)
+        return plan
+
+    def run_threads(self, plan, concurrency, url):
+        def punch(uid):
+            started = time.perf_counter()
+            try:
+                if url:
+                    try:
+                        with urlopen(f"{url.rstrip('/')}{PUNCH_PATH}?{urlencode({'uid': uid})}") as response:
+                            outcome = response.status
+                    except HTTPError as e:
+                        outcome = e.code
+                else:
+                    outcome = Client().get(PUNCH_PATH, {'uid': uid}).status_code
+            except OperationalError as e:
+                outcome = 'lock' if 'locked' in str(e) else 'error'
+            except Exception:
+                outcome = 'error'
+            finally:
+                close_old_connections()
+            return outcome, time.perf_counter() - started
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            return list(pool.map(punch, plan))
+
+    async def run_asyncio(self, plan, concurrency, url):
+        semaphore = asyncio.Semaphore(concurrency)
+        client = AsyncClient()
+
+        async def http_get(uid):
+            parts = urlsplit(url)
+            reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+            writer.write((f"GET {PUNCH_PATH}?{urlencode({'uid': uid})} HTTP/1.1\r\n"
+                          f"Host: {parts.netloc}\r\nConnection: close\r\n\r\n").encode())
+            await writer.drain()
+            status_line = await reader.readline()
+            writer.close()
+            return int(status_line.split()[1])
+
+        async def punch(uid):
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    if url:
+                        outcome = await http_get(uid)
+                    else:
+                        outcome = (await client.get(PUNCH_PATH, {'uid': uid})).status_code
+                except OperationalError as e:
+                    outcome = 'lock' if 'locked' in str(e) else 'error'
+                except Exception:
+                    outcome = 'error'
+                return outcome, time.perf_counter() - started
+
+        return await asyncio.gather(*(punch(uid) for uid in plan))
+
+    def report(self, samples, elapsed, prefix, in_process):
+        latencies = sorted(latency * 1000 for outcome, latency in samples)
+        outcomes = Counter(outcome for outcome, latency in samples)
+        duplicate_open = (Shift.objects.filter(exit_time=None, employee__uid__startswith=prefix)
+                          .values('employee').annotate(open_count=Count('id')).filter(open_count__gt=1).count())
+
+        self.stdout.write(f"Punches:         {len(samples)} in {elapsed:.2f}s")
+        self.stdout.write(f"Throughput:      {len(samples) / elapsed:.1f} punches/s")
+        self.stdout.write(f"Latency (ms):    p50 {percentile(latencies, 50):.1f}  "
+                          f"p95 {percentile(latencies, 95):.1f}  p99 {percentile(latencies, 99):.1f}  "
+                          f"max {latencies[-1]:.1f}")
+        self.stdout.write(f"Responses:       {dict(sorted((str(k), v) for k, v in outcomes.items()))}")
+        self.stdout.write(f"Lock errors:     {outcomes.get('lock', 0)}")
+        if in_process:
+            self.stdout.write(f"uid cache:       {uid_cache.stats()}")
+
+        style = self.style.ERROR if duplicate_open else self.style.SUCCESS
+        self.stdout.write(style(f"Duplicate open shifts: {duplicate_open}"))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from main.helper.search import DOCUMENTS, fts_supported, rebuild_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text search index from the users and companies tables."
+
+    def add_arguments(self, parser):
+        parser.add_argument('kinds', nargs='*', help=f"Documents to rebuild: {', '.join(sorted(DOCUMENTS))} (default: all).")
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        if not fts_supported():
+            raise CommandError("The search index lives in SQLite FTS5 tables; this database has none to rebuild.")
+
+        unknown = set(options['kinds']) - set(DOCUMENTS)
+        if unknown:
+            raise CommandError(f"Unknown search documents: {', '.join(sorted(unknown))}.")
+
+        for kind in options['kinds'] or sorted(DOCUMENTS):
+            count = rebuild_index(kind, options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f"Indexed {count} {kind} documents."))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from main.helper.summary import rebuild_summaries
+
+
+class Command(BaseCommand):
+    help = "Rebuild the ShiftDailySummary table from scratch out of the closed shifts."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = rebuild_summaries(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Wrote {count} daily summary rows."))
@@ -0,0 +1,30 @@
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def close_duplicate_open_shifts(apps, schema_editor):
+    """Keep only the latest open shift per employee so the constraint can be added."""
+    Shift = apps.get_model('main', 'Shift')
+    seen = set()
+    open_shifts = Shift.objects_all.filter(exit_time=None, is_deleted=False).order_by('employee_id', '-enter_time', '-id')
+    for obj in open_shifts.iterator():
+        if obj.employee_id in seen:
+            obj.exit_time = obj.enter_time or timezone.now()
+            obj.save(update_fields=['exit_time'])
+        else:
+            seen.add(obj.employee_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(close_duplicate_open_shifts, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='shift',
+            constraint=models.UniqueConstraint(condition=models.Q(('exit_time', None), ('is_deleted', False)), fields=('employee',), name='unique_open_shift_per_employee'),
+        ),
+    ]
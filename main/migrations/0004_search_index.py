@@ -0,0 +1,61 @@
+from django.db import migrations, models
+
+
+SEARCH_DOCUMENTS = {
+    'main_search_user': ('auth_user', ('username', 'email', 'first_name', 'last_name')),
+    'main_search_company': ('main_company', ('name', 'city')),
+}
+
+
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA compile_options")
+            if 'ENABLE_FTS5' not in {row[0] for row in cursor.fetchall()}:
+                return
+
+        for table, (source, fields) in SEARCH_DOCUMENTS.items():
+            body = " || ' ' || ".join(f"coalesce({field}, '')" for field in fields)
+            schema_editor.execute(f"CREATE VIRTUAL TABLE {table} USING fts5("
+                                  f"body, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')")
+            schema_editor.execute(f"INSERT INTO {table} (rowid, body) SELECT id, {body} FROM {source}")
+
+    elif connection.vendor == 'postgresql':
+        schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        for table, (source, fields) in SEARCH_DOCUMENTS.items():
+            for field in fields:
+                # Matches the UPPER(col::text) LIKE UPPER(%s) that Django emits for icontains.
+                schema_editor.execute(f"CREATE INDEX IF NOT EXISTS {source}_{field}_trgm_idx ON {source} "
+                                      f"USING gin (UPPER({field}::text) gin_trgm_ops)")
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+
+    if connection.vendor == 'sqlite':
+        for table in SEARCH_DOCUMENTS:
+            schema_editor.execute(f"DROP TABLE IF EXISTS {table}")
+
+    elif connection.vendor == 'postgresql':
+        for table, (source, fields) in SEARCH_DOCUMENTS.items():
+            for field in fields:
+                schema_editor.execute(f"DROP INDEX IF EXISTS {source}_{field}_trgm_idx")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_hot_query_indexes'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='company',
+            name='city',
+            field=models.CharField(db_index=True, max_length=55),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,59 @@
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def build_summaries(apps, schema_editor):
+    # A frozen copy of main.helper.summary.rebuild_summaries, so later changes there cannot alter this migration.
+    Shift = apps.get_model('main', 'Shift')
+    ShiftDailySummary = apps.get_model('main', 'ShiftDailySummary')
+    zone = timezone.get_default_timezone()
+
+    totals = defaultdict(lambda: [0, 0])
+    rows = (Shift.objects_all.filter(is_deleted=False, enter_time__isnull=False, exit_time__isnull=False)
+            .order_by().values_list('employee_id', 'employee__company_id', 'enter_time', 'exit_time'))
+    for employee_id, company_id, enter_time, exit_time in rows.iterator(2000):
+        day, start = timezone.localtime(enter_time, zone).date(), enter_time
+        while start < exit_time:
+            end = min(timezone.make_aware(datetime.combine(day + timedelta(days=1), time.min), zone), exit_time)
+            total = totals[employee_id, company_id, day]
+            total[0] += (end - start).total_seconds()
+            total[1] += 1
+            day, start = day + timedelta(days=1), end
+
+    ShiftDailySummary.objects.bulk_create(
+        (ShiftDailySummary(employee_id=employee_id, company_id=company_id, date=day,
+                           seconds=round(seconds), shifts=shifts)
+         for (employee_id, company_id, day), (seconds, shifts) in totals.items()),
+        batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShiftDailySummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('seconds', models.PositiveIntegerField(default=0)),
+                ('shifts', models.PositiveIntegerField(default=0)),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_summaries', to='main.company')),
+                ('employee', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_summaries', to='main.employee')),
+            ],
+            options={
+                'verbose_name_plural': 'shift daily summaries',
+                'ordering': ('-date', 'employee'),
+                'indexes': [models.Index(fields=['company', 'date'], name='summary_company_date_idx')],
+                'constraints': [models.UniqueConstraint(fields=('employee', 'company', 'date'), name='unique_shift_daily_summary')],
+            },
+        ),
+        migrations.RunPython(build_summaries, migrations.RunPython.noop),
+    ]
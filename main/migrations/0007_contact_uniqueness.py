@@ -0,0 +1,69 @@
+import re
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+# As main.helper.uniqueness normalized contacts when this migration was written; kept here unchanged.
+def normalize_email(email):
+    return (email or '').strip().lower()
+
+
+def normalize_phone(phone_number):
+    phone_number = re.sub(r'[\s\-().]', '', phone_number or '')
+    return phone_number or None
+
+
+def normalize_contacts(apps, schema_editor):
+    User = apps.get_model('auth', 'User')
+    Profile = apps.get_model('main', 'Profile')
+
+    for user in User.objects.exclude(email='').only('id', 'email').iterator():
+        email = normalize_email(user.email)
+        if email != user.email:
+            User.objects.filter(pk=user.pk).update(email=email)
+
+    for profile in Profile.objects.only('id', 'phone_number').iterator():
+        phone_number = normalize_phone(profile.phone_number)
+        if phone_number != profile.phone_number:
+            Profile.objects.filter(pk=profile.pk).update(phone_number=phone_number)
+
+    duplicates = [f"email {row['email']}" for row in User.objects.exclude(email='').values('email')
+                  .annotate(n=Count('id')).filter(n__gt=1)]
+    duplicates += [f"phone number {row['phone_number']}" for row in Profile.objects.exclude(phone_number=None)
+                   .values('phone_number').annotate(n=Count('id')).filter(n__gt=1)]
+    if duplicates:
+        raise RuntimeError("Resolve the accounts sharing these contacts before migrating: " + ', '.join(duplicates))
+
+
+def create_email_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        # Users without an email keep ''; only real addresses must be unique.
+        schema_editor.execute("CREATE UNIQUE INDEX auth_user_email_uniq ON auth_user (email) WHERE email <> ''")
+    else:
+        schema_editor.execute("CREATE INDEX auth_user_email_uniq ON auth_user (email)")
+
+
+def drop_email_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'mysql':
+        schema_editor.execute("DROP INDEX auth_user_email_uniq ON auth_user")
+    else:
+        schema_editor.execute("DROP INDEX auth_user_email_uniq")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_shift_daily_summary'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_contacts, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='profile',
+            name='phone_number',
+            field=models.CharField(blank=True, max_length=13, null=True, unique=True),
+        ),
+        migrations.RunPython(create_email_index, drop_email_index),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_contact_uniqueness'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='shift',
+            name='shift_live_employee_idx',
+        ),
+        migrations.AddIndex(
+            model_name='shift',
+            index=models.Index(fields=['employee', '-enter_time', '-exit_time', '-id'], name='shift_employee_time_idx'),
+        ),
+        migrations.AlterField(
+            model_name='shift',
+            name='employee',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='employee', to='main.employee'),
+        ),
+    ]
@@ -1,12 +1,25 @@
+from asgiref.sync import sync_to_async
 from django.db import models
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.utils import timezone
 
-from .helper.ModelManager import DeletedManager, EmployeeManager
-from .helper.exceptions import ForbiddenException, CustomError
+from .helper.ModelManager import DeletedManager, CompanyManager, EmployeeManager, ShiftManager
+from .helper.exceptions import ForbiddenException
 from .helper.utils import generate_rand_string
+from .helper.cache import uid_cache
+from .helper.journal import get_punch_journal
+from .helper.punch import claim_punch, remember_punch, release_punch, aclaim_punch, aremember_punch, arelease_punch
+from .helper.membership import invalidate_membership, invalidate_all_memberships
+from .helper.search import sync_user_document, sync_company_document, drop_user_document, drop_company_document
+from .helper.summary import refresh_summaries, shift_days
+from .helper.catalogue import role_catalogue
+from .helper.uniqueness import normalize_email, normalize_phone
+
+
+def normalize_user_email(sender, instance, **kwargs):
+    instance.email = normalize_email(instance.email)
 
 
 def create_profile(sender, instance, created, **kwargs):
@@ -14,9 +27,61 @@ def create_profile(sender, instance, created, **kwargs):
         Profile.objects.create(user_id=instance.id)
 
 
+def touch_profile(sender, instance, created, raw=False, **kwargs):
+    # Profile.updated_at stands in for the user row, which has no such column (see helper/conditional.py).
+    if not created and not raw:
+        Profile.objects.filter(user_id=instance.id).update(updated_at=timezone.now())
+
+
+def invalidate_employee_uid(sender, instance, **kwargs):
+    uid_cache.discard_where(lambda uid, resolved: uid == instance.uid or
+                            (resolved is not None and resolved.employee_id == instance.pk))
+
+
+def invalidate_company_uids(sender, instance, **kwargs):
+    uid_cache.discard_where(lambda uid, resolved: resolved is not None and resolved.company_id == instance.pk)
+
+
+def invalidate_employee_membership(sender, instance, **kwargs):
+    invalidate_membership(instance.user_id)
+
+
+def invalidate_company_memberships(sender, instance, **kwargs):
+    invalidate_all_memberships()
+
+
+def invalidate_role_catalogue(sender, instance, **kwargs):
+    role_catalogue.invalidate()
+
+
+def remember_shift_days(sender, instance, raw=False, **kwargs):
+    # The days the shift counted towards before this save, so an edit also corrects them.
+    before = None
+    if instance.pk and not raw:
+        before = sender.objects_all.filter(pk=instance.pk).values_list('employee_id', 'enter_time', 'exit_time').first()
+    instance._summary_before = (before[0], shift_days(*before[1:])) if before else None
+
+
+def refresh_shift_summary(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+
+    days = {instance.employee_id: shift_days(instance.enter_time, instance.exit_time)}
+    before = getattr(instance, '_summary_before', None)
+    if before:
+        days.setdefault(before[0], set()).update(before[1])
+    refresh_summaries(days)
+
+
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
-    phone_number = models.CharField(max_length=13, null=True, blank=True)
+    phone_number = models.CharField(max_length=13, null=True, blank=True, unique=True)
+    # Also bumped when the user row is saved.
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def save(self, *args, **kwargs):
+        self.phone_number = normalize_phone(self.phone_number)
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.user.username
@@ -25,19 +90,24 @@ class Profile(models.Model):
 class Company(models.Model):
     name = models.CharField(max_length=255, unique=True)
     number = models.IntegerField(unique=True, verbose_name='Company Number')
-    city = models.CharField(max_length=55)
+    city = models.CharField(max_length=55, db_index=True)
     create_date = models.DateTimeField(auto_now_add=True)
     foundation_date = models.DateField()
     is_deleted = models.BooleanField(default=False)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name="companies")
+    updated_at = models.DateTimeField(auto_now=True)
 
     objects_all = models.Manager()
-    objects = DeletedManager()
+    objects = CompanyManager(select_related=('created_by', ))
 
     class Meta:
         unique_together = ('name', 'number')
         verbose_name_plural = 'companies'
         ordering = ('-foundation_date', '-create_date', )
+        indexes = [
+            models.Index(fields=('created_by', '-foundation_date', '-create_date'),
+                         condition=models.Q(is_deleted=False), name='company_live_owner_idx'),
+        ]
 
     def clean(self):
         if self.foundation_date > timezone.now().date():
@@ -58,6 +128,7 @@ class Company(models.Model):
 class Role(models.Model):
     name = models.CharField(max_length=55)
     is_deleted = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
 
     objects_all = models.Manager()
     objects = DeletedManager()
@@ -76,13 +147,20 @@ class Employee(models.Model):
     role = models.ForeignKey('Role', on_delete=models.CASCADE, related_name='employee_role')
     is_deleted = models.BooleanField(default=False)
     is_accepted = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
 
     objects_all = models.Manager()
-    objects = EmployeeManager()
+    objects = EmployeeManager(select_related=('user__profile', 'role', 'company'))
 
     class Meta:
         unique_together = ('user', 'company')
         ordering = ('company', 'user')
+        indexes = [
+            models.Index(fields=('company', 'is_accepted'),
+                         condition=models.Q(is_deleted=False), name='employee_live_company_idx'),
+            models.Index(fields=('user', 'is_accepted'),
+                         condition=models.Q(is_deleted=False), name='employee_live_user_idx'),
+        ]
 
     def clean(self):
         if self.id:
@@ -100,16 +178,39 @@ class Employee(models.Model):
 
 
 class Shift(models.Model):
-    employee = models.ForeignKey('Employee', on_delete=models.CASCADE, related_name='employee')
+    # Indexed by shift_employee_time_idx, which leads with the employee.
+    employee = models.ForeignKey('Employee', on_delete=models.CASCADE, related_name='employee', db_index=False)
     enter_time = models.DateTimeField(null=True, blank=True)
     exit_time = models.DateTimeField(null=True, blank=True)
     is_deleted = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
 
     objects_all = models.Manager()
-    objects = DeletedManager()
+    objects = ShiftManager(select_related=('employee__user', 'employee__company'),
+                           only=('enter_time', 'exit_time', 'employee__user__username',
+                                 'employee__user__first_name', 'employee__user__last_name',
+                                 'employee__company__name'),
+                           keyset=(('enter_time', True, False), ('exit_time', True, False), ('id', True, None)))
 
     class Meta:
         ordering = ('-enter_time', '-exit_time')
+        constraints = [
+            models.UniqueConstraint(fields=('employee', ),
+                                    condition=models.Q(exit_time=None, is_deleted=False),
+                                    name='unique_open_shift_per_employee'),
+        ]
+        indexes = [
+            # Matches the keyset order, so one employee's shifts are read in order without a sort. It covers
+            # deleted rows too: as the only index on employee it also serves cascades and objects_all.
+            models.Index(fields=('employee', '-enter_time', '-exit_time', '-id'), name='shift_employee_time_idx'),
+        ]
+
+    def delete(self, *args, **kwargs):
+        # Not a post_delete receiver: that would stop cascades from Employee and Company from
+        # fast-deleting shifts, and their summary rows are deleted by their own foreign keys anyway.
+        result = super().delete(*args, **kwargs)
+        refresh_summaries({self.employee_id: shift_days(self.enter_time, self.exit_time)})
+        return result
 
     def clean(self):
         if self.id and not self.is_deleted and not self.employee.user.is_staff and self.exit_time:
@@ -124,46 +225,137 @@ class Shift(models.Model):
             if self.exit_time < self.enter_time:
                 raise ValidationError(f"Shift Time is not valid.")
 
-    def add_shift_sys(self, emp_obj):
-        try:
-            obj = Shift.objects.get(exit_time=None, employee=emp_obj)
-        except Shift.DoesNotExist:
-            self.employee = emp_obj
-            self.clean()
-            self.save()
-
-            if not self.exit_time:
-                result = f"Shift Started on {timezone.now().strftime('%Y/%m/%d at %H:%M')}."
-            else:
-                result = f"Shift Ended on {timezone.now().strftime('%Y/%m/%d at %H:%M')}."
-        else:
-            obj.clean()
-            obj.save()
+    @staticmethod
+    def punch_message(started, when):
+        if started:
+            return f"Shift Started on {when.strftime('%Y/%m/%d at %H:%M')}."
 
-            if obj.exit_time:
-                result = f"Shift Ended on {timezone.now().strftime('%Y/%m/%d at %H:%M')}."
+        return f"Shift Ended on {when.strftime('%Y/%m/%d at %H:%M')}."
+
+    def add_shift_by_id(self, employee_id):
+        duplicate = claim_punch(employee_id)
+        if duplicate:
+            return duplicate
+
+        now = timezone.now()
+        journal = get_punch_journal()
+        try:
+            if journal:
+                journal.append(employee_id, now)
+                result = f"Punch recorded on {now.strftime('%Y/%m/%d at %H:%M')}."
             else:
-                raise CustomError(f"Something went wrong")
+                result = self.punch_message(Shift.objects.toggle(employee_id, now), now)
+        except Exception:
+            release_punch(employee_id)
+            raise
 
+        remember_punch(employee_id, result)
         return result
 
+    def add_shift_sys(self, emp_obj):
+        return self.add_shift_by_id(emp_obj.pk)
+
     def add_shift_by_uid(self, uid):
+        resolved = Employee.objects.resolve_uid(uid)
+        if not resolved or not resolved.active:
+            raise ForbiddenException()
+
+        return self.add_shift_by_id(resolved.employee_id)
+
+    def add_shift(self, user, company_id=None):
         try:
-            emp_obj = Employee.objects.get(uid=uid)
+            emp_obj = Employee.objects.only('id').get(user=user, company_id=company_id)
         except Employee.DoesNotExist:
             raise ForbiddenException()
 
         return self.add_shift_sys(emp_obj)
 
-    def add_shift(self, user, company_id=None):
+    async def aadd_shift_by_id(self, employee_id):
+        duplicate = await aclaim_punch(employee_id)
+        if duplicate:
+            return duplicate
+
+        now = timezone.now()
+        journal = get_punch_journal()
+        try:
+            if journal:
+                await sync_to_async(journal.append, thread_sensitive=False)(employee_id, now)
+                result = f"Punch recorded on {now.strftime('%Y/%m/%d at %H:%M')}."
+            else:
+                result = self.punch_message(await Shift.objects.atoggle(employee_id, now), now)
+        except Exception:
+            await arelease_punch(employee_id)
+            raise
+
+        await aremember_punch(employee_id, result)
+        return result
+
+    async def aadd_shift_by_uid(self, uid):
+        resolved = await Employee.objects.aresolve_uid(uid)
+        if not resolved or not resolved.active:
+            raise ForbiddenException()
+
+        return await self.aadd_shift_by_id(resolved.employee_id)
+
+    async def aadd_shift(self, user, company_id=None):
         try:
-            emp_obj = Employee.objects.get(user=user, company_id=company_id)
+            emp_obj = await Employee.objects.only('id').aget(user=user, company_id=company_id)
         except Employee.DoesNotExist:
             raise ForbiddenException()
 
-        return self.add_shift_sys(emp_obj)
+        return await self.aadd_shift_by_id(emp_obj.pk)
 
     def __str__(self):
         return f"{self.id}"
 
     post_save.connect(create_profile, sender=User)
+
+
+class ShiftDailySummary(models.Model):
+    """
+    Worked time per employee and local calendar day (settings.TIME_ZONE), maintained from
+    closed shifts; shifts crossing midnight are split between the days. Rebuild it with
+    ``manage.py rebuild_shift_summary``.
+    """
+    employee = models.ForeignKey('Employee', on_delete=models.CASCADE, related_name='daily_summaries')
+    company = models.ForeignKey('Company', on_delete=models.CASCADE, related_name='daily_summaries')
+    date = models.DateField()
+    seconds = models.PositiveIntegerField(default=0)
+    shifts = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'shift daily summaries'
+        ordering = ('-date', 'employee')
+        constraints = [
+            models.UniqueConstraint(fields=('employee', 'company', 'date'), name='unique_shift_daily_summary'),
+        ]
+        indexes = [
+            models.Index(fields=('company', 'date'), name='summary_company_date_idx'),
+        ]
+
+    @property
+    def hours(self):
+        return round(self.seconds / 3600, 2)
+
+    def __str__(self):
+        return f"{self.employee} {self.date}"
+
+
+post_save.connect(invalidate_employee_uid, sender=Employee)
+post_delete.connect(invalidate_employee_uid, sender=Employee)
+post_save.connect(invalidate_company_uids, sender=Company)
+post_delete.connect(invalidate_company_uids, sender=Company)
+post_save.connect(invalidate_employee_membership, sender=Employee)
+post_delete.connect(invalidate_employee_membership, sender=Employee)
+post_save.connect(invalidate_company_memberships, sender=Company)
+post_delete.connect(invalidate_company_memberships, sender=Company)
+pre_save.connect(normalize_user_email, sender=User)
+post_save.connect(touch_profile, sender=User)
+post_save.connect(invalidate_role_catalogue, sender=Role)
+post_delete.connect(invalidate_role_catalogue, sender=Role)
+pre_save.connect(remember_shift_days, sender=Shift)
+post_save.connect(refresh_shift_summary, sender=Shift)
+post_save.connect(sync_user_document, sender=User)
+post_delete.connect(drop_user_document, sender=User)
+post_save.connect(sync_company_document, sender=Company)
+post_delete.connect(drop_company_document, sender=Company)
@@ -1,3 +1,1319 @@
-from django.test import TestCase
+import base64
+import io
+import json
+import os
+import tempfile
+from datetime import date, datetime, timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command, CommandError
+from django.db import connection, transaction, IntegrityError, OperationalError
+from django.test import AsyncClient, Client, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import path, resolve
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from .api.async_views import AsyncShiftAddView, AsyncShiftView
+from .api.renderers import FastJSONRenderer
+from .api.serializers import EditUserSerializer
+from .forms import UserForm
+from .helper.badge import badge_cache, badge_digest, badge_path, get_badge, store_badge
+from .helper.breadcrumbs import breadcrumbs, route_breadcrumbs
+from .helper.cache import LRUCache, MISSING, uid_cache
+from .helper.catalogue import role_catalogue
+from .helper.exceptions import CustomError
+from .helper.export import XLSX_AVAILABLE
+from .helper.journal import FlushLock, PunchJournal, fcntl
+from .helper.membership import compute_membership, get_membership, get_user_membership, shared_cache
+from .helper.search import search_filter
+from .helper.summary import rebuild_summaries
+from .helper.uniqueness import find_taken_fields
+from .helper.utils import keyset_paginate, keyset_ordering
+from .models import Company, Role, Employee, Shift, ShiftDailySummary, Profile
+from .views import CompanyDetailsView
+
+
+@skipUnless(connection.vendor == 'sqlite', "reads SQLite's EXPLAIN QUERY PLAN")
+class QueryPlanTests(TestCase):
+    """The list queries the panel and API views actually run use the indexes added for them."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', password='secret')
+        role = Role.objects.create(name='worker')
+        cls.company = Company.objects.create(name='acme', number=1, city='x', foundation_date='2020-01-01',
+                                             created_by=cls.owner)
+        other = Company.objects.create(name='other', number=2, city='x', foundation_date='2020-01-01',
+                                       created_by=User.objects.create_user('other_owner'))
+        cls.employees = [Employee.objects.create(uid=f'uid{i}', user=User.objects.create_user(f'u{i}', password='secret'),
+                                                 company=cls.company, role=role, is_accepted=True)
+                         for i in range(3)]
+        # u0 also works for, and is invited to, other companies.
+        Employee.objects.create(uid='uid-other', user=cls.employees[0].user, company=other, role=role, is_accepted=True)
+        Employee.objects.create(uid='uid-owner', user=cls.owner, company=other, role=role)
+
+        now = timezone.now()
+        Shift.objects.bulk_create(Shift(employee=employee, enter_time=now - timedelta(days=day, hours=9),
+                                        exit_time=now - timedelta(days=day))
+                                  for employee in cls.employees for day in range(5))
+
+    def setUp(self):
+        # Membership lookups are cached across requests; run them here so their plans are checked too.
+        cache.clear()
+
+    def plans(self, username, url):
+        """(sql, EXPLAIN QUERY PLAN) of every SELECT the view ran."""
+        self.client.force_login(User.objects.get(username=username))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        plans = []
+        for query in queries.captured_queries:
+            if query['sql'].startswith('SELECT'):
+                with connection.cursor() as cursor:
+                    cursor.execute(f"EXPLAIN QUERY PLAN {query['sql']}")
+                    plans.append((query['sql'], ' | '.join(row[-1] for row in cursor.fetchall())))
+        return plans
+
+    def plan_of(self, plans, *fragments):
+        matching = [plan for sql, plan in plans if all(fragment in sql for fragment in fragments)]
+        self.assertEqual(len(matching), 1, f"expected one query with {fragments}, got {len(matching)}")
+        return matching[0]
+
+    def assertUses(self, plan, index):
+        self.assertIn(index, plan)
+
+    def test_own_shifts(self):
+        # ProfileView and ShiftView merge the user's employments, so the ORDER BY needs a sort.
+        for url in ('/panel/profile', '/panel/shift/'):
+            plans = self.plans('u0', url)
+            self.assertUses(self.plan_of(plans, 'FROM "main_shift"', 'ORDER BY'), 'shift_employee_time_idx')
+
+    def test_employee_shifts_need_no_sort(self):
+        plans = self.plans('owner', f'/panel/employee/{self.employees[0].id}/')
+        plan = self.plan_of(plans, 'FROM "main_shift"', 'ORDER BY')
+        self.assertUses(plan, 'shift_employee_time_idx')
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_company_details(self):
+        plans = self.plans('owner', f'/panel/company/{self.company.id}/')
+        self.assertUses(self.plan_of(plans, 'FROM "main_shift"', 'ORDER BY'), 'shift_employee_time_idx')
+        self.assertUses(self.plan_of(plans, 'FROM "main_employee"', 'ORDER BY'), 'employee_live_company_idx')
+
+    def test_all_employees(self):
+        plans = self.plans('owner', '/panel/employee/all')
+        self.assertUses(self.plan_of(plans, 'FROM "main_employee"', 'ORDER BY'), 'employee_live_company_idx')
+
+    def test_company_list(self):
+        plans = self.plans('owner', '/panel/company/')
+        # The membership ids (owned UNION ALL employed) and the pending invitations.
+        self.assertUses(self.plan_of(plans, 'UNION ALL'), 'employee_live_user_idx')
+        self.assertUses(self.plan_of(plans, 'NOT "main_employee"."is_accepted"'), 'employee_live_user_idx')
+
+    def test_api_shifts(self):
+        plans = self.plans('u0', '/api/shift/')
+        self.assertUses(self.plan_of(plans, 'FROM "main_shift"', 'ORDER BY'), 'shift_employee_time_idx')
+
+
+def local(*args):
+    return timezone.make_aware(datetime(*args))
+
+
+class PunchTests(TestCase):
+    """ShiftManager.toggle, the open-shift constraint and the offline backlog replay."""
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create_user('owner')
+        role = Role.objects.create(name='worker')
+        company = Company.objects.create(name='acme', number=1, city='x', foundation_date='2020-01-01', created_by=owner)
+        cls.employee, cls.other = [Employee.objects.create(uid=f'uid{i}', user=User.objects.create_user(f'u{i}'),
+                                                           company=company, role=role, is_accepted=True)
+                                   for i in range(2)]
+
+    def test_toggle_opens_then_closes(self):
+        enter, leave = local(2024, 1, 1, 9), local(2024, 1, 1, 17)
+        with self.assertNumQueries(2 + 2):  # SELECT and INSERT, plus the atomic block's SAVEPOINT and RELEASE.
+            self.assertTrue(Shift.objects.toggle(self.employee.id, enter))
+        self.assertFalse(Shift.objects.toggle(self.employee.id, leave))
+
+        shift = Shift.objects.get(employee=self.employee)
+        self.assertEqual((shift.enter_time, shift.exit_time), (enter, leave))
+
+    def test_closing_refreshes_the_summary_after_the_punch(self):
+        Shift.objects.toggle(self.employee.id, local(2024, 1, 1, 9))
+        with self.captureOnCommitCallbacks() as callbacks:
+            # SELECT and UPDATE, plus SAVEPOINT and RELEASE; the summary waits for the commit.
+            with self.assertNumQueries(2 + 2):
+                Shift.objects.toggle(self.employee.id, local(2024, 1, 1, 17))
+        self.assertFalse(ShiftDailySummary.objects.exists())
+
+        # Its read and upsert, without re-reading the shift.
+        with self.assertNumQueries(2):
+            callbacks[0]()
+        self.assertEqual(ShiftDailySummary.objects.get().seconds, 8 * 3600)
+
+    def test_one_open_shift_per_employee(self):
+        Shift.objects.create(employee=self.employee, enter_time=local(2024, 1, 1, 9))
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Shift.objects.create(employee=self.employee, enter_time=local(2024, 1, 1, 10))
+
+    def test_double_punch_keeps_one_open_shift(self):
+        Shift.objects.create(employee=self.employee, enter_time=local(2024, 1, 1, 9))
+        # A concurrent punch opened the shift after ours looked for one: our INSERT loses to the constraint.
+        with mock.patch('django.db.models.query.QuerySet.first', return_value=None):
+            self.assertTrue(Shift.objects.toggle(self.employee.id, local(2024, 1, 1, 9, 0, 1)))
+
+        shift = Shift.objects.get(employee=self.employee)
+        self.assertEqual((shift.enter_time, shift.exit_time), (local(2024, 1, 1, 9), None))
+
+    def test_apply_punches(self):
+        Shift.objects.create(employee=self.other, enter_time=local(2024, 1, 1, 8))
+        punches = [(self.employee.id, local(2024, 1, 1, 17)),
+                   (self.employee.id, local(2024, 1, 1, 9)),
+                   (self.other.id, local(2024, 1, 1, 16)),
+                   (self.employee.id, local(2024, 1, 1, 9)),
+                   (self.employee.id, local(2024, 1, 1, 18))]
+        self.assertEqual(Shift.objects.apply_punches(punches),
+                         ['ended', 'started', 'ended', 'duplicate', 'started'])
+
+        self.assertEqual(list(Shift.objects.filter(employee=self.employee).order_by('enter_time')
+                              .values_list('enter_time', 'exit_time')),
+                         [(local(2024, 1, 1, 9), local(2024, 1, 1, 17)), (local(2024, 1, 1, 18), None)])
+        self.assertEqual(Shift.objects.get(employee=self.other).exit_time, local(2024, 1, 1, 16))
+        self.assertEqual(dict(ShiftDailySummary.objects.values_list('employee_id', 'seconds')),
+                         {self.employee.id: 8 * 3600, self.other.id: 8 * 3600})
+
+        # Replaying the same backlog changes nothing.
+        self.assertEqual(Shift.objects.apply_punches(punches), ['duplicate'] * len(punches))
+        self.assertEqual(Shift.objects.filter(employee=self.employee).count(), 2)
+
+
+class ShiftSummaryTests(TestCase):
+    """ShiftDailySummary follows the shifts it is built from, split at local midnight."""
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create_user('owner')
+        company = Company.objects.create(name='acme', number=1, city='x', foundation_date='2020-01-01', created_by=owner)
+        cls.employee = Employee.objects.create(uid='uid0', user=User.objects.create_user('u0'), company=company,
+                                               role=Role.objects.create(name='worker'), is_accepted=True)
+
+    def summary(self):
+        return dict(ShiftDailySummary.objects.filter(employee=self.employee).values_list('date', 'seconds'))
+
+    def test_split_at_midnight(self):
+        Shift.objects.toggle(self.employee.id, local(2024, 1, 1, 22))
+        self.assertEqual(self.summary(), {})
+        with self.captureOnCommitCallbacks(execute=True):
+            Shift.objects.toggle(self.employee.id, local(2024, 1, 2, 3))
+        self.assertEqual(self.summary(), {date(2024, 1, 1): 2 * 3600, date(2024, 1, 2): 3 * 3600})
+
+    def test_edit_moves_the_days(self):
+        shift = Shift.objects.create(employee=self.employee, enter_time=local(2024, 1, 1, 9),
+                                     exit_time=local(2024, 1, 1, 17))
+        self.assertEqual(self.summary(), {date(2024, 1, 1): 8 * 3600})
+
+        shift.enter_time, shift.exit_time = local(2024, 1, 3, 9), local(2024, 1, 3, 10)
+        shift.save()
+        self.assertEqual(self.summary(), {date(2024, 1, 3): 3600})
+
+    def test_delete_refreshes(self):
+        kept, soft, hard = [Shift.objects.create(employee=self.employee, enter_time=local(2024, 1, day, 9),
+                                                 exit_time=local(2024, 1, day, 10)) for day in (1, 2, 3)]
+        soft.is_deleted = True
+        soft.save()
+        hard.delete()
+        self.assertEqual(self.summary(), {date(2024, 1, 1): 3600})
+
+        self.assertEqual(rebuild_summaries(), 1)
+        self.assertEqual(self.summary(), {date(2024, 1, 1): 3600})
+
+
+class KeysetPaginationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create_user('owner')
+        company = Company.objects.create(name='acme', number=1, city='x', foundation_date='2020-01-01', created_by=owner)
+        employee = Employee.objects.create(uid='uid0', user=owner, company=company, role=Role.objects.create(name='r'))
+        start = local(2024, 1, 1, 9)
+        # Two shifts share their times, so only the id orders them; the open one sorts first.
+        Shift.objects.bulk_create([Shift(employee=employee, enter_time=start + timedelta(days=day),
+                                         exit_time=start + timedelta(days=day, hours=8)) for day in (0, 0, 1, 2, 3)])
+        Shift.objects.create(employee=employee, enter_time=start + timedelta(days=4))
+        cls.shifts = Shift.objects_all.all()
+        cls.ordered = list(cls.shifts.order_by(*keyset_ordering(Shift.objects.keyset)).values_list('id', flat=True))
+
+    def walk(self, cursor, attribute):
+        pages = []
+        while cursor:
+            page = keyset_paginate(cursor, self.shifts, Shift.objects.keyset, per_page=2)
+            pages.append([shift.id for shift in page])
+            cursor = getattr(page, attribute)
+        return pages
+
+    def test_next_and_previous(self):
+        first = keyset_paginate(None, self.shifts, Shift.objects.keyset, per_page=2)
+        self.assertIsNone(first.previous_cursor)
+        self.assertEqual([shift.id for shift in first], self.ordered[:2])
+
+        forward = [[shift.id for shift in first]] + self.walk(first.next_cursor, 'next_cursor')
+        self.assertEqual(forward, [self.ordered[:2], self.ordered[2:4], self.ordered[4:]])
+
+        last = keyset_paginate(first.next_cursor, self.shifts, Shift.objects.keyset, per_page=2)
+        last = keyset_paginate(last.next_cursor, self.shifts, Shift.objects.keyset, per_page=2)
+        self.assertIsNone(last.next_cursor)
+        self.assertEqual(self.walk(last.previous_cursor, 'previous_cursor'), [self.ordered[2:4], self.ordered[:2]])
+
+    def test_garbage_cursor_is_the_first_page(self):
+        page = keyset_paginate('not-a-cursor', self.shifts, Shift.objects.keyset, per_page=2)
+        self.assertEqual([shift.id for shift in page], self.ordered[:2])
+
+
+class UniquenessTests(TestCase):
+    """The single uniqueness query, and the constraint reporting a write that lost the race to it."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('taken', email='taken@x.com')
+        Profile.objects.filter(user=cls.user).update(phone_number='09120000000')
+
+    def test_taken_fields(self):
+        with self.assertNumQueries(1):
+            taken = find_taken_fields('taken', ' Taken@X.com ', '0912 000 0000')
+        self.assertEqual(taken, {'username', 'email', 'phone_number'})
+        self.assertEqual(find_taken_fields('taken', 'taken@x.com', exclude=self.user.pk), set())
+        self.assertEqual(find_taken_fields('free', 'free@x.com', '0912'), set())
+
+    def test_form_reports_lost_race(self):
+        form = UserForm(data={'username': 'racer', 'password': 'secret', 'first_name': 'A', 'last_name': 'B',
+                              'phone_number': '09121111111', 'email': 'taken@x.com'})
+        with mock.patch('main.forms.find_taken_fields', return_value=set()):
+            self.assertTrue(form.is_valid())
+        self.assertIsNone(form.save_or_report())
+        self.assertEqual(form.errors['email'], ['Email is already in use!'])
+        self.assertFalse(User.objects.filter(username='racer').exists())
+
+    def test_serializer_reports_lost_race(self):
+        serializer = EditUserSerializer(data={'username': 'racer', 'email': 'free@x.com', 'password': 'secret',
+                                              'phone_number': '09120000000'})
+        self.assertTrue(serializer.is_valid())
+        with mock.patch('main.api.serializers.find_taken_fields', return_value=set()), \
+                self.assertRaises(ValidationError) as raised:
+            serializer.save()
+        self.assertEqual(raised.exception.detail, {'phone_number': 'Phone number already exists.'})
+        self.assertFalse(User.objects.filter(username='racer').exists())
+
+
+class ConditionalListTests(TestCase):
+    """Polled lists answer 304 until their rows, or the rows they render, change."""
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create_user('owner')
+        cls.company = Company.objects.create(name='acme', number=1, city='x', foundation_date='2020-01-01',
+                                             created_by=owner)
+        cls.role = Role.objects.create(name='worker')
+        cls.employee = Employee.objects.create(uid='uid0', user=User.objects.create_user('u0'), company=cls.company,
+                                               role=cls.role, is_accepted=True)
+        Shift.objects.create(employee=cls.employee, enter_time=local(2024, 1, 1, 9), exit_time=local(2024, 1, 1, 17))
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.employee.user)
+
+    def assertRevalidates(self, url, change):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Last-Modified', response)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        change()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_new_shift(self):
+        self.assertRevalidates('/panel/shift/', lambda: Shift.objects.toggle(self.employee.id))
+
+    def test_soft_deleted_shift(self):
+        shift = Shift.objects.get()
+        self.assertRevalidates('/panel/shift/', lambda: Shift.objects.filter(pk=shift.pk).update(is_deleted=True))
+
+    def test_renamed_company(self):
+        def rename():
+            self.company.name = 'renamed'
+            self.company.save()
+        self.assertRevalidates('/panel/shift/', rename)
+
+    def test_renamed_user(self):
+        def rename():
+            self.employee.user.first_name = 'renamed'
+            self.employee.user.save()
+        self.assertRevalidates('/panel/shift/', rename)
+
+    def test_api_list(self):
+        def rename():
+            self.role.name = 'renamed'
+            self.role.save()
+        self.assertRevalidates('/api/role/', rename)
+
+    def test_other_user_never_matches(self):
+        etag = self.client.get('/panel/shift/')['ETag']
+        self.client.force_login(User.objects.get(username='owner'))
+        self.assertEqual(self.client.get('/panel/shift/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class SearchTests(TestCase):
+    """The declared ``__prefix`` filters and the ``q`` full-text search of the API lists."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', email='alice@x.com', first_name='Alice', last_name='Smith')
+        cls.bob = User.objects.create_user('bob', email='bob@x.com', first_name='Bob', last_name='Jones')
+        User.objects.create_user('alina', is_active=False)
+        cls.tehran = Company.objects.create(name='Acme', number=1, city='Tehran', foundation_date='2020-01-01',
+                                            created_by=cls.alice)
+        Company.objects.create(name='Acorn', number=2, city='Shiraz', foundation_date='2020-01-01',
+                               created_by=cls.alice)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.bob)
+
+    def usernames(self, query):
+        response = self.client.get(f'/api/user/{query}')
+        self.assertEqual(response.status_code, 200)
+        return sorted(row['username'] for row in response.json()['results'])
+
+    def test_prefix_lookup(self):
+        cities = lambda prefix: list(Company.objects.filter(city__prefix=prefix).values_list('city', flat=True))
+        self.assertEqual(cities('Teh'), ['Tehran'])
+        self.assertEqual(cities('Tehran'), ['Tehran'])
+        self.assertEqual(cities('Tehranx'), [])
+        # A B-tree range, so case-sensitive unlike the LIKE it replaced.
+        self.assertEqual(cities('teh'), [])
+
+    def test_declared_filters(self):
+        self.client.force_login(self.alice)
+        response = self.client.get('/api/company/?city=Teh&ignored=1')
+        self.assertEqual([row['name'] for row in response.json()['results']], ['Acme'])
+
+    def test_user_list_shows_only_yourself_without_a_search(self):
+        self.assertEqual(self.usernames(''), ['bob'])
+
+    def test_username_prefix(self):
+        self.assertEqual(self.usernames('?username=ali'), ['alice'])
+        self.assertEqual(self.usernames('?username=alice&q=ali'), ['alice'])
+
+    @skipUnless(connection.vendor == 'sqlite', "the FTS5 index only exists on SQLite")
+    def test_full_text_search(self):
+        self.assertEqual(self.usernames('?q=ali'), ['alice'])
+        self.assertEqual(self.usernames('?q=SMI'), ['alice'])
+        self.assertEqual(self.usernames('?q=alice jones'), [])
+
+        self.client.force_login(self.alice)
+        response = self.client.get('/api/company/?q=teh')
+        self.assertEqual([row['name'] for row in response.json()['results']], ['Acme'])
+
+    @skipUnless(connection.vendor == 'sqlite', "the FTS5 index only exists on SQLite")
+    def test_signals_keep_the_index_in_sync(self):
+        self.alice.last_name = 'Walker'
+        self.alice.save()
+        self.assertEqual(self.usernames('?q=walk'), ['alice'])
+        self.assertEqual(self.usernames('?q=smith'), [])
+
+        carol = User.objects.create_user('carol', first_name='Carol')
+        self.assertEqual(self.usernames('?q=carol'), ['carol'])
+        carol.delete()
+        self.assertEqual(self.usernames('?q=carol'), [])
+
+        self.tehran.city = 'Isfahan'
+        self.tehran.save()
+        self.assertEqual(list(Company.objects.filter(search_filter('company', '', 'isfa')).values_list('name', flat=True)),
+                         ['Acme'])
+
+
+class APIRouteTests(TestCase):
+    """The routed API views and their IsStaffOrReadOnly / IsCompanyOwnerOrReadOnly rules."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', email='owner@x.com')
+        cls.worker = User.objects.create_user('worker', email='worker@x.com')
+        cls.staff = User.objects.create_user('staff', is_staff=True)
+        cls.role = Role.objects.create(name='worker')
+        cls.company = Company.objects.create(name='acme', number=1, city='x', foundation_date='2020-01-01',
+                                             created_by=cls.owner)
+        cls.employee = Employee.objects.create(uid='uid0', user=cls.worker, company=cls.company, role=cls.role,
+                                               is_accepted=True)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_anonymous_is_denied(self):
+        for url in ('/api/user/', '/api/company/', '/api/role/', '/api/employee/', '/api/shift/'):
+            self.assertEqual(self.client.get(url).status_code, 403, url)
+
+    def test_user_details(self):
+        self.client.force_login(self.worker)
+        own = self.client.get(f'/api/user/{self.worker.pk}/').json()
+        self.assertEqual(own['email'], 'worker@x.com')
+
+        other = self.client.get(f'/api/user/{self.owner.pk}/').json()
+        self.assertEqual(other['username'], 'owner')
+        self.assertNotIn('email', other)
+        self.assertNotIn('profile', other)
+
+    def test_user_put_edits_yourself(self):
+        self.client.force_login(self.worker)
+        response = self.client.put('/api/user/', {'username': 'worker2', 'email': 'w2@x.com', 'password': 'secret',
+                                                  'phone_number': '09121111111'}, content_type='application/json')
+        self.assertRedirects(response, f'/api/user/{self.worker.pk}/', fetch_redirect_response=False)
+        self.worker.refresh_from_db()
+        self.assertEqual((self.worker.username, self.worker.email), ('worker2', 'w2@x.com'))
+
+        # The new password ends the session, as any password change does.
+        self.client.force_login(self.worker)
+        self.assertEqual(self.client.get(response['Location']).json()['username'], 'worker2')
+
+    def test_roles_are_written_by_staff_only(self):
+        self.client.force_login(self.owner)
+        self.assertEqual(self.client.get('/api/role/').status_code, 200)
+        self.assertEqual(self.client.post('/api/role/', {'name': 'boss'}).status_code, 403)
+
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.post('/api/role/', {'name': 'boss'}).status_code, 302)
+        self.assertTrue(Role.objects.filter(name='boss').exists())
+
+    def test_company_is_written_by_its_owner_only(self):
+        url = f'/api/company/{self.company.pk}/'
+        data = {'name': 'renamed', 'number': 1, 'city': 'x', 'foundation_date': '2020-01-01'}
+
+        self.client.force_login(self.worker)
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.client.put(url, data, content_type='application/json').status_code, 403)
+        self.assertEqual(self.client.delete(url).status_code, 403)
+
+        self.client.force_login(self.owner)
+        self.assertEqual(self.client.put(url, data, content_type='application/json').status_code, 302)
+        self.company.refresh_from_db()
+        self.assertEqual((self.company.name, self.company.created_by), ('renamed', self.owner))
+
+    def test_employee_is_written_by_the_company_owner_only(self):
+        url = f'/api/employee/{self.employee.pk}/'
+        self.client.force_login(self.worker)
+        self.assertEqual(self.client.delete(url).status_code, 403)
+        self.assertEqual(self.client.post('/api/employee/', {'company': self.company.pk, 'user': self.staff.pk,
+                                                             'role': self.role.pk}).status_code, 403)
+
+        self.client.force_login(self.owner)
+        response = self.client.post('/api/employee/', {'company': self.company.pk, 'user': self.staff.pk,
+                                                       'role': self.role.pk})
+        self.assertEqual(response.status_code, 302)
+        invited = Employee.objects_all.get(user=self.staff)
+        self.assertFalse(invited.is_accepted)
+        self.assertEqual(self.client.delete(url).status_code, 204)
+
+    def test_shift_is_deleted_by_the_company_owner_only(self):
+        shift = Shift.objects.create(employee=self.employee, enter_time=local(2024, 1, 1, 9),
+                                     exit_time=local(2024, 1, 1, 17))
+        url = f'/api/shift/{shift.pk}/'
+        self.client.force_login(self.worker)
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.client.delete(url).status_code, 403)
+
+        self.client.force_login(self.owner)
+        self.assertEqual(self.client.delete(url).status_code, 204)
+
+
+class PunchJournalTests(TestCase):
+    """The write-behind journal: append, batched flush, harmless replay and the single-flusher lock."""
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create_user('owner')
+        company = Company.objects.create(name='acme', number=1, city='x', foundation_date='2020-01-01', created_by=owner)
+        cls.employee = Employee.objects.create(uid='uid0', user=User.objects.create_user('u0'), company=company,
+                                               role=Role.objects.create(name='worker'), is_accepted=True)
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'journal.sqlite3')
+        self.journal = PunchJournal(self.path)
+        self.punches = [(self.employee.id, local(2024, 1, 1, 9)), (self.employee.id, local(2024, 1, 1, 17))]
+
+    def append(self, punches):
+        for employee_id, when in punches:
+            self.journal.append(employee_id, when)
+
+    def test_flush_applies_and_discards(self):
+        self.append(self.punches)
+        self.assertEqual(self.journal.flush(batch_size=1), 2)
+        self.assertEqual(self.journal.pending(10), [])
+
+        shift = Shift.objects.get(employee=self.employee)
+        self.assertEqual((shift.enter_time, shift.exit_time), (local(2024, 1, 1, 9), local(2024, 1, 1, 17)))
+
+    def test_replay_is_harmless(self):
+        self.append(self.punches)
+        self.journal.flush()
+        # A crash between applying a batch and discarding it leaves the same rows behind.
+        self.append(self.punches)
+        self.journal.flush()
+        self.assertEqual(Shift.objects.filter(employee=self.employee).count(), 1)
+
+    def test_removed_employees_are_dropped(self):
+        self.append([(self.employee.id + 1000, local(2024, 1, 1, 9))])
+        with self.assertLogs('main.helper.journal', 'WARNING'):
+            self.assertEqual(self.journal.flush(), 0)
+        self.assertEqual(self.journal.pending(10), [])
+
+    @skipUnless(fcntl, "flush locks need fcntl")
+    def test_one_flusher_per_journal(self):
+        holder, other = FlushLock(self.path), FlushLock(self.path)
+        self.assertTrue(holder.acquire())
+        self.assertFalse(other.acquire())
+        holder.release()
+        self.assertTrue(other.acquire())
+        other.release()
+
+    @skipUnless(fcntl, "flush locks need fcntl")
+    def test_command_takes_the_lock(self):
+        self.append(self.punches)
+        holder = FlushLock(self.path)
+        holder.acquire()
+        with self.assertRaises(CommandError):
+            call_command('flush_punch_journal', path=self.path, stdout=io.StringIO())
+        self.assertEqual(len(self.journal.pending(10)), 2)
+
+        holder.release()
+        out = io.StringIO()
+        call_command('flush_punch_journal', path=self.path, stdout=out)
+        self.assertIn('Applied 2 journaled punches.', out.getvalue())
+
+
+class BatchPunchTests(TestCase):
+    """api/shift/batch, the offline kiosks' replay of punches by badge uid."""
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create_user('owner')
+        company = Company.objects.create(name='acme', number=1, city='x', foundation_date='2020-01-01', created_by=owner)
+        cls.employee = Employee.objects.create(uid='uid0', user=User.objects.create_user('u0'), company=company,
+                                               role=Role.objects.create(name='worker'), is_accepted=True)
+
+    def setUp(self):
+        cache.clear()
+
+    def post(self, punches):
+        return self.client.post('/api/shift/batch', [{'uid': uid, 'timestamp': when.isoformat()}
+                                                     for uid, when in punches], content_type='application/json')
+
+    def test_batch(self):
+        response = self.post([('uid0', local(2024, 1, 1, 17)), ('uid0', local(2024, 1, 1, 9)),
+                              ('nobody', local(2024, 1, 1, 9)), ('uid0', local(2024, 1, 1, 9))])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row['status'] for row in response.json()], ['ended', 'started', 'rejected', 'duplicate'])
+
+        shift = Shift.objects.get(employee=self.employee)
+        self.assertEqual((shift.enter_time, shift.exit_time), (local(2024, 1, 1, 9), local(2024, 1, 1, 17)))
+
+    def test_future_punches_are_rejected(self):
+        response = self.post([('uid0', local(2099, 1, 1))])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'0': {'timestamp': ['Punch time is in the future.']}})
+        self.assertFalse(Shift.objects_all.exists())
+
+    def test_small_clock_skew_is_accepted(self):
+        response = self.post([('uid0', timezone.now() + timedelta(seconds=60))])
+        self.assertEqual([row['status'] for row in response.json()], ['started'])
+
+    def test_shift_is_never_closed_before_it_started(self):
+        self.post([('uid0', timezone.now() + timedelta(seconds=60))])
+        with self.assertRaisesMessage(CustomError, Shift.objects.early_punch_message):
+            Shift.objects.toggle(self.employee.id)
+
+        response = self.client.get('/api/shift/add?uid=uid0')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Shift.objects.get(employee=self.employee).exit_time, None)
+
+
+# The punch endpoints as PUNCH_ASYNC routes them, for AsyncPunchTests.
+urlpatterns = [
+    path('api/shift/add', AsyncShiftAddView.as_view()),
+    path('api/shift/', AsyncShiftView.as_view()),
+]
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class AsyncPunchTests(TestCase):
+    """The async punch views authenticate like their DRF counterparts, CSRF included."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('u0', password='secret')
+        owner = User.objects.create_user('owner')
+        cls.company = Company.objects.create(name='acme', number=1, city='x', foundation_date='2020-01-01',
+                                             created_by=owner)
+        cls.employee = Employee.objects.create(uid='uid0', user=cls.user, company=cls.company,
+                                               role=Role.objects.create(name='worker'), is_accepted=True)
+
+    def setUp(self):
+        cache.clear()
+        self.client = AsyncClient(enforce_csrf_checks=True)
+
+    def basic(self, password='secret'):
+        return {'AUTHORIZATION': 'Basic ' + base64.b64encode(f'u0:{password}'.encode()).decode()}
+
+    async def test_basic_auth(self):
+        response = await self.client.post(f'/api/shift/?company_id={self.company.id}', headers=self.basic())
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['details'].startswith('Shift Started'))
+        self.assertTrue(await Shift.objects.filter(employee=self.employee, exit_time=None).aexists())
+
+    async def test_bad_credentials_and_anonymous(self):
+        response = await self.client.post(f'/api/shift/?company_id={self.company.id}', headers=self.basic('wrong'))
+        self.assertEqual(response.status_code, 403)
+        response = await self.client.post(f'/api/shift/?company_id={self.company.id}')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(await Shift.objects_all.aexists())
+
+    async def test_session_needs_csrf(self):
+        await self.client.aforce_login(self.user)
+        response = await self.client.post(f'/api/shift/?company_id={self.company.id}')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(await Shift.objects_all.aexists())
+
+    async def test_kiosk_punch(self):
+        response = await self.client.get('/api/shift/add?uid=uid0')
+        self.assertEqual(response.status_code, 200)
+        response = await self.client.get('/api/shift/add?uid=nobody')
+        self.assertEqual(response.status_code, 403)
+
+    def test_sync_view_agrees(self):
+        client = Client(enforce_csrf_checks=True)
+        with override_settings(ROOT_URLCONF='EmpSystem.urls'):
+            response = client.post(f'/api/shift/?company_id={self.company.id}', headers=self.basic())
+            self.assertEqual(response.status_code, 200)
+            client.force_login(self.user)
+            self.assertEqual(client.post(f'/api/shift/?company_id={self.company.id}').status_code, 403)
+
+
+@override_settings(PUNCH_DEBOUNCE_SECONDS=5)
+class PunchDebounceTests(TestCase):
+    """Repeated scans within the debounce window and requests retried with an Idempotency-Key."""
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create_user('owner')
+        cls.company = Company.objects.create(name='acme', number=1, city='x', foundation_date='2020-01-01',
+                                             created_by=owner)
+        role = Role.objects.create(name='worker')
+        cls.employees = [Employee.objects.create(uid=f'uid{i}', user=User.objects.create_user(f'u{i}'),
+                                                 company=cls.company, role=role, is_accepted=True)
+                         for i in range(2)]
+
+    def setUp(self):
+        cache.clear()
+
+    def scan(self, uid='uid0', **headers):
+        return self.client.get(f'/api/shift/add?uid={uid}', headers=headers).json()['details']
+
+    def test_repeated_scan_is_absorbed(self):
+        first = self.scan()
+        self.assertEqual(self.scan(), first)
+        self.assertEqual(Shift.objects.filter(employee=self.employees[0]).count(), 1)
+        self.assertIsNone(Shift.objects.get(employee=self.employees[0]).exit_time)
+
+    def test_failed_punch_releases_the_window(self):
+        with mock.patch.object(type(Shift.objects), 'toggle', side_effect=OperationalError('database is locked')):
+            with self.assertRaises(OperationalError):
+                self.scan()
+        self.assertTrue(self.scan().startswith('Shift Started'))
+
+    async def test_failed_async_punch_releases_the_window(self):
+        employee_id = self.employees[0].id
+        with mock.patch.object(type(Shift.objects), 'atoggle', side_effect=OperationalError('database is locked')):
+            with self.assertRaises(OperationalError):
+                await Shift().aadd_shift_by_id(employee_id)
+        self.assertTrue((await Shift().aadd_shift_by_id(employee_id)).startswith('Shift Started'))
+
+    @override_settings(PUNCH_DEBOUNCE_SECONDS=0)
+    def test_idempotency_key_replays_the_response(self):
+        first = self.scan(**{'Idempotency-Key': 'k1'})
+        self.assertEqual(self.scan(**{'Idempotency-Key': 'k1'}), first)
+        self.assertEqual(Shift.objects.filter(employee=self.employees[0]).count(), 1)
+
+        # The key is scoped by the badge, so another kiosk reusing it still punches.
+        self.assertTrue(self.scan('uid1', **{'Idempotency-Key': 'k1'}).startswith('Shift Started'))
+        # And a new key is a new punch.
+        self.assertTrue(self.scan(**{'Idempotency-Key': 'k2'}).startswith('Shift Ended'))
+
+    @override_settings(PUNCH_DEBOUNCE_SECONDS=0)
+    def test_idempotency_key_is_scoped_by_user(self):
+        url = f'/api/shift/?company_id={self.company.id}'
+        self.client.force_login(self.employees[0].user)
+        first = self.client.post(url, headers={'Idempotency-Key': 'k1'}).json()
+        self.assertEqual(self.client.post(url, headers={'Idempotency-Key': 'k1'}).json(), first)
+        self.assertEqual(Shift.objects.count(), 1)
+
+        self.client.force_login(self.employees[1].user)
+        self.client.post(url, headers={'Idempotency-Key': 'k1'})
+        self.assertEqual(Shift.objects.filter(employee=self.employees[1]).count(), 1)
+
+
+@override_settings(ONBOARDING_HASH_WORKERS=1)
+class EmployeeImportTests(TestCase):
+    """CSV onboarding: the whole file is validated first, and nothing is written unless all of it is valid."""
+
+    header = 'username,password,first_name,last_name,phone_number,email,role\n'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner')
+        cls.company = Company.objects.create(name='acme', number=1, city='x', foundation_date='2020-01-01',
+                                             created_by=cls.owner)
+        cls.role = Role.objects.create(name='worker')
+        cls.joined = User.objects.create_user('joined', email='joined@x.com')
+        Employee.objects.create(uid='uid0', user=cls.joined, company=cls.company, role=cls.role, is_accepted=True)
+        cls.former = User.objects.create_user('former')
+        Employee.objects.create(uid='uid1', user=cls.former, company=cls.company, role=cls.role, is_accepted=True,
+                                is_deleted=True)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.owner)
+
+    def upload(self, content):
+        if isinstance(content, str):
+            content = content.encode()
+        response = self.client.post(f'/panel/company/{self.company.id}/import_employees',
+                                    {'file': SimpleUploadedFile('employees.csv', content, 'text/csv')})
+        self.assertEqual(response.status_code, 200)
+        return response.context['result'], list(response.context['errors'])
+
+    def test_import(self):
+        result, errors = self.upload(self.header + 'new1,pw,A,B,0912-000-0001,New1@X.com,worker\n'
+                                                   f'former,,,,,,{self.role.pk}\n')
+        self.assertEqual((result, errors), ('2 employees added successfully!', []))
+
+        new = User.objects.get(username='new1')
+        self.assertTrue(new.check_password('pw'))
+        self.assertEqual((new.email, new.profile.phone_number), ('new1@x.com', '09120000001'))
+        self.assertTrue(Employee.objects_all.filter(user=new, company=self.company, is_accepted=False).exists())
+        self.assertFalse(Employee.objects_all.get(user=self.former).is_deleted)
+        # bulk_create skips the signals, so the import indexes the new users itself.
+        self.assertEqual(list(User.objects.filter(search_filter('user', '', 'new1'))), [new])
+
+    def test_reimport_reports_nothing_added(self):
+        content = self.header + 'new1,pw,A,B,09120000001,new1@x.com,worker\n'
+        self.upload(content)
+        self.assertEqual(self.upload(content), (None, ['Line 2: new1 is already invited to this company!']))
+
+    def test_errors_are_reported_per_line(self):
+        result, errors = self.upload(self.header + 'joined,,,,,,worker\n'
+                                                   'owner,,,,,,worker\n'
+                                                   'x1,pw,A,B,09120000002,bad-email,worker\n'
+                                                   'x2,pw,A,B,09120000003,joined@x.com,worker\n'
+                                                   'x3,pw,A,B,09120000004,x3@x.com,nobody\n'
+                                                   'x4,pw,,B,09120000005,x4@x.com,worker\n'
+                                                   f'{"u" * 151},pw,A,B,09120000006,x5@x.com,worker\n'
+                                                   f'x6,pw,{"A" * 151},B,09120000007,x6@x.com,worker\n'
+                                                   'x7,pw,A,B,09120000008999,x7@x.com,worker\n'
+                                                   'x8,pw,A,B,09120000009,x8@x.com,worker\n'
+                                                   'x8,pw,A,B,09120000010,x9@x.com,worker\n')
+        self.assertIsNone(result)
+        self.assertEqual(errors, [
+            'Line 2: joined is already joined to this company!',
+            'Line 3: You can not add yourself as Employee!',
+            'Line 4: bad-email is not a valid email address.',
+            'Line 5: Email joined@x.com is already in use!',
+            "Line 6: Role 'nobody' does not exist!",
+            'Line 7: First name can not be empty.',
+            'Line 8: Username can be at most 150 characters.',
+            'Line 9: First name can be at most 150 characters.',
+            'Line 10: Phone number can be at most 13 characters.',
+            'Line 12: x8 appears more than once in the file.',
+        ])
+        # x8's first row was valid, but nothing is written while any row is not.
+        self.assertFalse(User.objects.filter(username='x8').exists())
+
+    def test_unreadable_files(self):
+        self.assertEqual(self.upload('name,role\nx,worker\n'), (None, ['The file has no username column.']))
+        result, errors = self.upload(self.header + '"' + 'a' * 200000 + '",worker\n')
+        self.assertEqual(len(errors), 1)
+        self.assertIn('the file is not a valid CSV', errors[0])
+        result, errors = self.upload(b'username,role\n\xff\xfe,worker\n')
+        self.assertEqual(len(errors), 1)
+
+
+class UidCacheTests(TestCase):
+    """Badge uid resolution through the in-process cache, kept fresh by the Employee and Company signals."""
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create_user('owner')
+        cls.company = Company.objects.create(name='acme', number=1, city='x', foundation_date='2020-01-01',
+                                             created_by=owner)
+        cls.role = Role.objects.create(name='worker')
+        cls.employee = Employee.objects.create(uid='uid0', user=User.objects.create_user('u0'), company=cls.company,
+                                               role=cls.role, is_accepted=True)
+
+    def setUp(self):
+        uid_cache.clear()
+        self.addCleanup(uid_cache.clear)
+
+    def test_hits_need_no_query(self):
+        with self.assertNumQueries(1):
+            resolved = Employee.objects.resolve_uid('uid0')
+        self.assertEqual(resolved, (self.employee.id, self.company.id, True))
+        with self.assertNumQueries(0):
+            self.assertEqual(Employee.objects.resolve_uid('uid0'), resolved)
+
+    async def test_async_lookups_share_the_cache(self):
+        resolved = await Employee.objects.aresolve_uid('uid0')
+        self.assertEqual(uid_cache.get('uid0'), resolved)
+
+    def test_unknown_uids_are_cached_until_an_employee_takes_them(self):
+        self.assertIsNone(Employee.objects.resolve_uid('new'))
+        with self.assertNumQueries(0):
+            self.assertIsNone(Employee.objects.resolve_uid('new'))
+
+        employee = Employee.objects.create(uid='new', user=User.objects.create_user('u1'), company=self.company,
+                                           role=self.role, is_accepted=True)
+        self.assertEqual(Employee.objects.resolve_uid('new').employee_id, employee.id)
+
+    def test_employee_changes_invalidate(self):
+        Employee.objects.resolve_uid('uid0')
+        self.employee.is_deleted = True
+        self.employee.save()
+        self.assertFalse(Employee.objects.resolve_uid('uid0').active)
+
+        # A new badge frees the old uid.
+        self.employee.is_deleted, self.employee.uid = False, 'uid9'
+        self.employee.save()
+        self.assertIsNone(Employee.objects.resolve_uid('uid0'))
+
+    def test_company_changes_invalidate(self):
+        Employee.objects.resolve_uid('uid0')
+        self.company.is_deleted = True
+        self.company.save()
+        self.assertFalse(Employee.objects.resolve_uid('uid0').active)
+
+    def test_lru_cache_bounds(self):
+        lru = LRUCache(maxsize=2, ttl=10)
+        with mock.patch('main.helper.cache.time.monotonic', return_value=100):
+            lru.set('a', 1)
+            lru.set('b', None)
+            lru.get('a')
+            lru.set('c', 3)
+            self.assertIs(lru.get('b'), MISSING)
+            self.assertIsNone(lru.get('missing', None))
+            self.assertEqual(lru.get('a'), 1)
+        with mock.patch('main.helper.cache.time.monotonic', return_value=111):
+            self.assertIs(lru.get('a'), MISSING)
+
+
+class CompanyOverviewTests(TestCase):
+    """The company list page: one query per list, with the totals read from the same query."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('u0', password='pw')
+        role = Role.objects.create(name='worker')
+        cls.owned = [Company.objects.create(name=f'own{i}', number=i, city='x', foundation_date='2020-01-01',
+                                            created_by=cls.user) for i in range(3)]
+        other = User.objects.create_user('other')
+        for i, accepted in enumerate((True, True, False)):
+            company = Company.objects.create(name=f'co{i}', number=10 + i, city='x', foundation_date='2020-01-01',
+                                             created_by=other)
+            Employee.objects.create(uid=f'uid{i}', user=cls.user, company=company, role=role, is_accepted=accepted)
+
+    def setUp(self):
+        cache.clear()
+
+    def overview(self, page=1):
+        request = RequestFactory().get('/panel/company/', {'page': page})
+        membership = compute_membership(self.user.id)
+        with CaptureQueriesContext(connection) as queries:
+            overview = Company.objects.get_overview(request, self.user, membership)
+        return overview, len(queries)
+
+    def test_three_queries_with_counts(self):
+        overview, queries = self.overview()
+        self.assertEqual(queries, 3)
+        self.assertEqual({name: page.paginator.count for name, page in overview.items()},
+                         {'owned': 3, 'employed': 2, 'pending': 1})
+        self.assertEqual({company.name for company in overview['owned']}, {'own0', 'own1', 'own2'})
+
+    def test_past_the_last_page_falls_back(self):
+        overview, _ = self.overview(page=5)
+        self.assertEqual(overview['owned'].number, 1)
+        self.assertEqual(overview['owned'].paginator.count, 3)
+
+    def test_page_renders(self):
+        self.client.login(username='u0', password='pw')
+        response = self.client.get('/panel/company/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['companies_owned_c'], 3)
+        self.assertEqual(response.context['pending_companies_c'], 1)
+
+
+class CompanyAccessTests(TestCase):
+    """Company detail pages resolve access once and only query the lists they render."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', password='pw')
+        cls.company = Company.objects.create(name='acme', number=1, city='x', foundation_date='2020-01-01',
+                                             created_by=cls.owner)
+        cls.member = User.objects.create_user('u0', password='pw')
+        Employee.objects.create(uid='uid0', user=cls.member, company=cls.company, role=Role.objects.create(name='w'),
+                                is_accepted=True)
+        cls.outsider = User.objects.create_user('u1', password='pw')
+
+    def setUp(self):
+        cache.clear()
+
+    def request_as(self, user):
+        request = RequestFactory().get(f'/panel/company/{self.company.id}/')
+        request.user = user
+        get_membership(request)
+        return request
+
+    def test_access(self):
+        view = CompanyDetailsView()
+        self.assertEqual(view.get_access(self.request_as(self.owner), self.company.id), (self.company, True))
+        self.assertEqual(view.get_access(self.request_as(self.member), self.company.id), (self.company, False))
+        request = self.request_as(self.outsider)
+        with self.assertNumQueries(0):
+            self.assertEqual(view.get_access(request, self.company.id), (None, False))
+
+    def test_lists_are_lazy(self):
+        request = self.request_as(self.owner)
+        with self.assertNumQueries(1):
+            data = CompanyDetailsView().get_obj(request, self.company.id)
+        with self.assertNumQueries(2):
+            self.assertEqual([employee.uid for employee in data['employees']], ['uid0'])
+        # The count comes from the page's paginator.
+        with self.assertNumQueries(0):
+            self.assertEqual(data['employees_c'], 1)
+
+    def test_routes(self):
+        self.client.login(username='u0', password='pw')
+        self.assertEqual(self.client.get(f'/panel/company/{self.company.id}/').status_code, 200)
+        # Only the creator edits; others are sent back to the details page.
+        self.assertRedirects(self.client.get(f'/panel/company/{self.company.id}/edit'),
+                             f'/panel/company/{self.company.id}/')
+
+        self.client.login(username='u1', password='pw')
+        self.assertEqual(self.client.get(f'/panel/company/{self.company.id}/').status_code, 404)
+
+
+@mock.patch('main.helper.membership.shared_cache', return_value=True)
+class MembershipCacheTests(TestCase):
+    """Cached memberships, dropped by the Employee and Company signals."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner')
+        cls.company = Company.objects.create(name='acme', number=1, city='x', foundation_date='2020-01-01',
+                                             created_by=cls.owner)
+        cls.role = Role.objects.create(name='worker')
+        cls.user = User.objects.create_user('u0')
+
+    def setUp(self):
+        cache.clear()
+
+    def test_cached_across_requests(self, shared):
+        self.assertEqual(get_user_membership(self.owner.id).owned, {self.company.id})
+        with self.assertNumQueries(0):
+            self.assertEqual(get_user_membership(self.owner.id).owned, {self.company.id})
+
+    def test_employee_changes_invalidate(self, shared):
+        self.assertEqual(get_user_membership(self.user.id).employed, frozenset())
+        employee = Employee.objects.create(uid='uid0', user=self.user, company=self.company, role=self.role,
+                                           is_accepted=True)
+        self.assertEqual(get_user_membership(self.user.id).employed, {self.company.id})
+
+        employee.is_deleted = True
+        employee.save()
+        self.assertEqual(get_user_membership(self.user.id).employed, frozenset())
+
+    def test_company_changes_invalidate_every_member(self, shared):
+        Employee.objects.create(uid='uid0', user=self.user, company=self.company, role=self.role, is_accepted=True)
+        get_user_membership(self.owner.id)
+        get_user_membership(self.user.id)
+
+        self.company.is_deleted = True
+        self.company.save()
+        self.assertEqual(get_user_membership(self.owner.id).owned, frozenset())
+        self.assertEqual(get_user_membership(self.user.id).employed, frozenset())
+
+    def test_process_local_cache_is_not_used(self, shared):
+        shared.return_value = False
+        get_user_membership(self.owner.id)
+        with self.assertNumQueries(1):
+            get_user_membership(self.owner.id)
+
+    def test_local_caches_are_not_shared(self, shared):
+        self.assertFalse(shared_cache())
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}):
+            self.assertTrue(shared_cache())
+            with override_settings(MEMBERSHIP_CACHE_TTL=0):
+                self.assertFalse(shared_cache())
+
+
+class SparseFieldsTests(TestCase):
+    """``?fields=`` and the values() list path, which must render what the model path renders."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner')
+        cls.company = Company.objects.create(name='acme', number=1, city='tehran', foundation_date='2020-01-01',
+                                             created_by=cls.owner)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.owner)
+
+    def test_list_matches_details(self):
+        listed = self.client.get('/api/company/').json()['results']
+        self.assertEqual(listed, [self.client.get(f'/api/company/{self.company.pk}/').json()])
+        self.assertEqual(listed[0]['foundation_date'], '2020-01-01')
+
+    def test_fields_narrow_the_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/company/', {'fields': 'id,name,bogus'})
+        self.assertEqual(response.json()['results'], [{'id': self.company.pk, 'name': 'acme'}])
+        listing = next(query['sql'] for query in queries if 'FROM "main_company"' in query['sql']
+                       and 'LIMIT' in query['sql'])
+        self.assertNotIn('"city"', listing)
+
+    def test_fields_on_details_and_stream(self):
+        details = self.client.get(f'/api/company/{self.company.pk}/', {'fields': 'city'}).json()
+        self.assertEqual(details, {'city': 'tehran'})
+
+        response = self.client.get('/api/company/', {'fields': 'number', 'stream': 1})
+        self.assertEqual(json.loads(b''.join(response.streaming_content)), [{'number': 1}])
+
+    def test_renderer_encodes_index_keyed_errors(self):
+        content = FastJSONRenderer().render({0: {'uid': ['Unknown.']}, 'detail': date(2020, 1, 1)})
+        self.assertEqual(json.loads(content), {'0': {'uid': ['Unknown.']}, 'detail': '2020-01-01'})
+
+
+class TimesheetExportTests(TestCase):
+    """The company timesheet export, streamed as CSV."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner')
+        cls.company = Company.objects.create(name='Acme Co', number=1, city='x', foundation_date='2020-01-01',
+                                             created_by=cls.owner)
+        user = User.objects.create_user('u0', first_name='Ali', last_name='Rezaei')
+        employee = Employee.objects.create(uid='uid0', user=user, company=cls.company,
+                                           role=Role.objects.create(name='worker'), is_accepted=True)
+        Shift.objects.create(employee=employee, enter_time=local(2024, 1, 1, 9), exit_time=local(2024, 1, 1, 17, 30))
+        Shift.objects.create(employee=employee, enter_time=local(2024, 1, 2, 23, 30))
+        # Local midnight starts the next day, outside the range.
+        Shift.objects.create(employee=employee, enter_time=local(2024, 1, 3, 0, 0), exit_time=local(2024, 1, 3, 1))
+
+    def setUp(self):
+        cache.clear()
+        self.url = f'/panel/company/{self.company.pk}/export'
+
+    def test_csv(self):
+        self.client.force_login(self.owner)
+        response = self.client.get(self.url, {'start': '2024-01-01', 'end': '2024-01-02'})
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename="acme-co-timesheet-2024-01-01-2024-01-02.csv"')
+        self.assertEqual(b''.join(response.streaming_content).decode().splitlines(), [
+            'Employee UID,Username,First name,Last name,Enter time,Exit time,Hours',
+            'uid0,u0,Ali,Rezaei,2024-01-01 09:00,2024-01-01 17:30,8.5',
+            'uid0,u0,Ali,Rezaei,2024-01-02 23:30,,',
+        ])
+
+    def test_bad_ranges(self):
+        self.client.force_login(self.owner)
+        self.assertEqual(self.client.get(self.url, {'start': '2024-01-02', 'end': '2024-01-01'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'start': '2024-13-01'}).status_code, 400)
+
+    def test_only_the_creator_exports(self):
+        self.client.force_login(User.objects.get(username='u0'))
+        self.assertRedirects(self.client.get(self.url), f'/panel/company/{self.company.pk}/')
+
+    @skipUnless(XLSX_AVAILABLE, "needs openpyxl")
+    def test_xlsx(self):
+        self.client.force_login(self.owner)
+        response = self.client.get(self.url, {'start': '2024-01-01', 'end': '2024-01-02', 'format': 'xlsx'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'PK'))
+
+    @skipUnless(not XLSX_AVAILABLE, "openpyxl is installed")
+    def test_xlsx_needs_openpyxl(self):
+        self.client.force_login(self.owner)
+        self.assertEqual(self.client.get(self.url, {'format': 'xlsx'}).status_code, 400)
+
+
+class RoleCatalogueTests(TestCase):
+    """The cached role catalogue, dropped whenever a role changes."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.role = Role.objects.create(name='worker')
+
+    def setUp(self):
+        cache.clear()
+
+    def test_served_from_the_cache(self):
+        self.assertEqual(role_catalogue.choices(), [(self.role.pk, 'worker')])
+        with self.assertNumQueries(0):
+            self.assertEqual(role_catalogue.get(str(self.role.pk)).name, 'worker')
+            self.assertEqual(role_catalogue.by_label()['worker'].pk, self.role.pk)
+            self.assertIsNone(role_catalogue.get('x'))
+            self.assertIsNone(role_catalogue.get(self.role.pk + 1))
+
+    def test_role_changes_invalidate(self):
+        role_catalogue.rows()
+        self.role.name = 'boss'
+        self.role.save()
+        self.assertEqual(role_catalogue.choices(), [(self.role.pk, 'boss')])
+
+        new = Role.objects.create(name='clerk')
+        self.assertIn('clerk', role_catalogue.by_label())
+
+        # Soft-deleted roles leave the catalogue, and so do deleted ones.
+        new.is_deleted = True
+        new.save()
+        self.assertNotIn('clerk', role_catalogue.by_label())
+        Role.objects_all.filter(pk=new.pk).first().delete()
+        self.role.delete()
+        self.assertEqual(role_catalogue.rows(), [])
+
+
+class BadgeTests(TestCase):
+    """QR badges, addressed by content and cached in memory and on disk."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner')
+        company = Company.objects.create(name='acme', number=1, city='x', foundation_date='2020-01-01',
+                                         created_by=cls.owner)
+        cls.employee = Employee.objects.create(uid='uid0', user=User.objects.create_user('u0'), company=company,
+                                               role=Role.objects.create(name='worker'), is_accepted=True)
+        cls.outsider = User.objects.create_user('u1')
+
+    def setUp(self):
+        cache.clear()
+        badge_cache.clear()
+        self.addCleanup(badge_cache.clear)
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.root = root.name
+        settings = override_settings(BADGE_ROOT=self.root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.url = f'/panel/employee/{self.employee.pk}/badge.svg'
+
+    def test_digest_follows_uid_and_style(self):
+        digest = badge_digest('uid0')
+        self.assertEqual(badge_digest('uid0'), digest)
+        self.assertNotEqual(badge_digest('uid1'), digest)
+        with mock.patch('main.helper.badge.BADGE_STYLE', 'other'):
+            self.assertNotEqual(badge_digest('uid0'), digest)
+
+    def test_memory_then_disk(self):
+        digest, content = get_badge('uid0', 'svg')
+        self.assertTrue(content.startswith(b'<?xml'))
+        path = badge_path(self.root, digest, 'svg')
+        self.assertEqual(path.read_bytes(), content)
+        self.assertEqual(os.listdir(path.parent), [path.name])
+
+        with mock.patch('main.helper.badge.store_badge') as store:
+            self.assertEqual(get_badge('uid0', 'svg'), (digest, content))
+        store.assert_not_called()
+
+        # A new process starts with an empty memory tier and reads the file.
+        badge_cache.clear()
+        with mock.patch('main.helper.badge.render_badge') as render:
+            self.assertEqual(get_badge('uid0', 'svg'), (digest, content))
+        render.assert_not_called()
+
+    def test_failed_writes_leave_no_file(self):
+        with mock.patch('main.helper.badge.os.replace', side_effect=OSError):
+            with self.assertRaises(OSError):
+                store_badge(self.root, 'uid0', 'svg')
+        path = badge_path(self.root, badge_digest('uid0'), 'svg')
+        self.assertEqual(os.listdir(path.parent), [])
+        self.assertEqual(store_badge(self.root, 'uid0', 'svg')[1], True)
+        self.assertEqual(store_badge(self.root, 'uid0', 'svg')[1], False)
+
+    def test_cache_headers(self):
+        self.client.force_login(self.owner)
+        response = self.client.get(self.url)
+        self.assertEqual(response['Content-Type'], 'image/svg+xml')
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        versioned = self.client.get(self.url, {'v': badge_digest('uid0')[:16]})
+        self.assertIn('immutable', versioned['Cache-Control'])
+        self.assertNotIn('immutable', self.client.get(self.url, {'v': 'stale'})['Cache-Control'])
+
+    def test_not_found(self):
+        self.client.force_login(self.employee.user)
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.assertEqual(self.client.get(f'/panel/employee/{self.employee.pk}/badge.gif').status_code, 404)
+
+        self.client.force_login(self.outsider)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+
+class BreadcrumbTests(TestCase):
+    """The panel breadcrumbs, built from the matched route or, failing that, the path."""
+
+    def test_route_breadcrumbs(self):
+        self.assertEqual(route_breadcrumbs('panel/company/<int:pk>/edit'), (
+            ('panel', '/panel/'),
+            ('panel>company', '/panel/company/'),
+            ('panel>company>{pk}', '/panel/company/{pk}/'),
+            ('panel>company>{pk}>edit', '/panel/company/{pk}/edit/'),
+        ))
+        self.assertEqual(route_breadcrumbs('a/{x}/<slug>'),
+                         (('a', '/a/'), ('a>{{x}}', '/a/{{x}}/'), ('a>{{x}}>{slug}', '/a/{{x}}/{slug}/')))
+
+        hits = route_breadcrumbs.cache_info().hits
+        route_breadcrumbs('panel/company/<int:pk>/edit')
+        self.assertEqual(route_breadcrumbs.cache_info().hits, hits + 1)
+
+    def test_resolved_route(self):
+        request = RequestFactory().get('/panel/company/7/edit')
+        request.resolver_match = resolve('/panel/company/7/edit')
+        self.assertEqual(breadcrumbs(request)[-2:], [
+            {'name': 'panel>company>7', 'url': '/panel/company/7/'},
+            {'name': 'panel>company>7>edit', 'url': '/panel/company/7/edit/'},
+        ])
+
+    def test_path_fallback(self):
+        request = RequestFactory().get('/panel/x/1/')
+        expected = [{'name': 'panel', 'url': '/panel/'}, {'name': 'panel>x', 'url': '/panel/x/'},
+                    {'name': 'panel>x>1', 'url': '/panel/x/1/'}]
+        self.assertEqual(breadcrumbs(request), expected)
+
+        request.resolver_match = mock.Mock(route='^panel/x/(?P<pk>[0-9]+)/$', kwargs={'pk': '1'})
+        self.assertEqual(breadcrumbs(request), expected)
+
+    def test_page_context(self):
+        owner = User.objects.create_user('owner')
+        company = Company.objects.create(name='acme', number=1, city='x', foundation_date='2020-01-01',
+                                         created_by=owner)
+        self.client.force_login(owner)
+        response = self.client.get(f'/panel/company/{company.pk}/')
+        self.assertEqual(response.context['url_three'][-1],
+                         {'name': f'panel>company>{company.pk}', 'url': f'/panel/company/{company.pk}/'})
@@ -1,7 +1,8 @@
 from django.urls import path
 from .views import (LoginUser, ProfileView, ShiftView, CompanyView, AcceptCompView,
                     CompanyCreateView, CompanyEditView, CompanyDetailsView, LogoutUser, EditProfile,
-                    CompanyEmpAddView, CompanyShiftAddView, AllEmployeesView, EmployeeDetailsView)
+                    CompanyEmpAddView, CompanyShiftAddView, AllEmployeesView, EmployeeDetailsView,
+                    CompanyExportView, CompanyEmpImportView, EmployeeBadgeView)
 
 urlpatterns = [
     path('', ProfileView.as_view()),
@@ -19,9 +20,12 @@ urlpatterns = [
     path('company/<int:pk>/accept', AcceptCompView.as_view(), name='company-accept'),
 
     path('company/<int:pk>/add_employee', CompanyEmpAddView.as_view(), name='add-employee'),
+    path('company/<int:pk>/import_employees', CompanyEmpImportView.as_view(), name='import-employees'),
     path('company/<int:pk>/add_shift', CompanyShiftAddView.as_view(), name='add-shift'),
+    path('company/<int:pk>/export', CompanyExportView.as_view(), name='company-export'),
 
     path('employee/all', AllEmployeesView.as_view(), name='all-employees'),
     path('employee/<int:pk>/', EmployeeDetailsView.as_view(), name='manage-employee'),
     path('employee/<int:pk>/remove', EmployeeDetailsView.as_view(), name='remove-employee'),
+    path('employee/<int:pk>/badge.<str:fmt>', EmployeeBadgeView.as_view(), name='employee-badge'),
 ]
\ No newline at end of file
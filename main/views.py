@@ -1,47 +1,35 @@
 from django.shortcuts import render, redirect
 from django.contrib.auth.views import LoginView, LogoutView
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.http import HttpResponseNotFound
+from django.http import (HttpResponse, HttpResponseNotFound, HttpResponseBadRequest, StreamingHttpResponse,
+                         FileResponse)
 from .helper.exceptions import CustomError, ForbiddenException
 from django.views import View
 from django.urls import reverse
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.utils.functional import SimpleLazyObject
+from django.utils.dateparse import parse_date
+from django.utils.text import slugify
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
 
 from .models import Shift, Company, Employee
-from .forms import CompanyForm, EmployeeForm, UserForm
-import qrcode
-import re
+from .forms import CompanyForm, EmployeeForm, EmployeeImportForm, UserForm
+from .helper.membership import get_membership
+from .helper.conditional import conditional_response, probe
+from .helper.export import timesheet_rows, stream_csv, write_xlsx, XLSX_AVAILABLE
+from .helper.summary import day_bounds
+from .helper.onboarding import EmployeeImport, read_employee_csv
+from .helper.breadcrumbs import breadcrumbs
+from .helper.badge import BADGE_CONTENT_TYPES, badge_digest, badge_formats, get_badge
 
 
-def process_current_site_url(request):
-    curl = re.sub('http.?://', '', request.build_absolute_uri())
-    curl = re.sub('\?(.+)', '', curl)
-    curl_splited = re.split("/", curl)
-    curl_splited = curl_splited[1:]
-
-    result = []
-
-    for i, item in enumerate(curl_splited):
-        if item:
-            data = {
-                'name': '>'.join(curl_splited[:i+1]),
-                'url': '/' + '/'.join(curl_splited[:i+1]) + '/'
-            }
-            result.append(data)
-
-    return result
-
-
-def generate_qr(data):
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(data)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    img.save(f'main/static/img/emp/{data}.png')
+def user_scope(request):
+    """What the panel chrome shows of the signed-in user, so editing it invalidates cached list pages."""
+    user = request.user
+    return user.username, user.first_name, user.last_name, user.email
 
 
 # Create your views here.
@@ -57,7 +45,7 @@ class RegisterView(View):
         form = UserForm()
         data = {
             'title': 'Create Account',
-            'url_three': process_current_site_url(request),
+            'url_three': breadcrumbs(request),
             'form': form
         }
         return render(request, 'registration/login.html', data)
@@ -67,12 +55,11 @@ class RegisterView(View):
 
         data = {
             'title': 'Edit User Profile',
-            'url_three': process_current_site_url(request),
+            'url_three': breadcrumbs(request),
             'form': form
         }
 
-        if form.is_valid():
-            form.save()
+        if form.is_valid() and form.save_or_report():
             return redirect('profile')
 
         return render(request, 'panel/profile/edit.html', data)
@@ -88,7 +75,7 @@ class ProfileView(LoginRequiredMixin, View):
     def get(self, request):
         data = {
             'title': 'User Information',
-            'url_three': process_current_site_url(request)
+            'url_three': breadcrumbs(request)
         }
 
         paginated_obj, obj = Shift.objects.get_paginated(request, employee__user=request.user)
@@ -104,7 +91,7 @@ class EditProfile(LoginRequiredMixin, View):
         form = UserForm(instance=request.user)
         data = {
             'title': 'Edit User Profile',
-            'url_three': process_current_site_url(request),
+            'url_three': breadcrumbs(request),
             'form': form
         }
         return render(request, 'panel/profile/edit.html', data)
@@ -114,12 +101,11 @@ class EditProfile(LoginRequiredMixin, View):
 
         data = {
             'title': 'Edit User Profile',
-            'url_three': process_current_site_url(request),
+            'url_three': breadcrumbs(request),
             'form': form
         }
 
-        if form.is_valid():
-            form.save()
+        if form.is_valid() and form.save_or_report():
             return redirect('profile')
 
         return render(request, 'panel/profile/edit.html', data)
@@ -131,8 +117,12 @@ class ShiftView(LoginRequiredMixin, View):
     def get(self, request):
         data = {
             'title': 'My Shift Records',
-            'url_three': process_current_site_url(request)
+            'url_three': breadcrumbs(request)
         }
+        versions = [probe(Shift.objects.filter(employee__user=request.user), 'employee__company', 'employee__user__profile')]
+        return conditional_response(request, versions, lambda: self.render_list(request, data), *user_scope(request))
+
+    def render_list(self, request, data):
         paginated_obj, obj = Shift.objects.get_paginated(request, employee__user=request.user)
         data['shift_list'] = paginated_obj
 
@@ -145,26 +135,24 @@ class CompanyView(LoginRequiredMixin, View):
     def get(self, request):
         data = {
             'title': 'My Companies',
-            'url_three': process_current_site_url(request)
+            'url_three': breadcrumbs(request)
         }
 
-        companies_owned, companies_owned_obj = Company.objects.get_paginated(request, created_by=request.user)
-        companies_emp, companies_emp_obj = Company.objects.get_paginated(request,
-                                                                           employees__user=request.user,
-                                                                           employees__is_deleted=False,
-                                                                           employees__is_accepted=True)
+        user = request.user
+        versions = [probe(Company.objects_all.filter(Q(created_by=user) | Q(employees__user=user)).distinct(),
+                          'created_by__profile'),
+                    probe(Employee.objects_all.filter(user=user))]
+        return conditional_response(request, versions, lambda: self.render_list(request, data), *user_scope(request))
 
-        pending_companies, pending_companies_obj = Company.objects.get_paginated(request,
-                                                                                 employees__user=request.user,
-                                                                                 employees__is_deleted=False,
-                                                                                 employees__is_accepted=False)
-        data['companies_owned'] = companies_owned
-        data['companies_employee'] = companies_emp
-        data['pending_companies'] = pending_companies
+    def render_list(self, request, data):
+        overview = Company.objects.get_overview(request, request.user, get_membership(request))
+        data['companies_owned'] = overview['owned']
+        data['companies_employee'] = overview['employed']
+        data['pending_companies'] = overview['pending']
 
-        data['companies_owned_c'] = companies_owned_obj.count()
-        data['companies_employee_c'] = companies_emp_obj.count()
-        data['pending_companies_c'] = pending_companies_obj.count()
+        data['companies_owned_c'] = overview['owned'].paginator.count
+        data['companies_employee_c'] = overview['employed'].paginator.count
+        data['pending_companies_c'] = overview['pending'].paginator.count
 
         return render(request, 'panel/company/list.html', data)
 
@@ -177,7 +165,7 @@ class CompanyCreateView(LoginRequiredMixin, View):
         data = {
             'title': 'Add New Company',
             'form': self.form_class(),
-            'url_three': process_current_site_url(request)
+            'url_three': breadcrumbs(request)
         }
         return render(request, 'panel/company/create.html', data)
 
@@ -192,7 +180,7 @@ class CompanyCreateView(LoginRequiredMixin, View):
         data = {
             'title': 'Add New Company',
             'form': form,
-            'url_three': process_current_site_url(request)
+            'url_three': breadcrumbs(request)
         }
         return render(request, 'panel/company/create.html', data)
 
@@ -200,37 +188,37 @@ class CompanyCreateView(LoginRequiredMixin, View):
 class CompanyDetailsView(LoginRequiredMixin, View):
     login_url = 'login'
 
+    def get_access(self, request, pk):
+        """Return the company and whether the caller created it; (None, False) without access."""
+        membership = get_membership(request)
+        if pk not in membership.owned and pk not in membership.employed:
+            return None, False
+
+        obj = Company.objects.filter(id=pk).first()
+        if not obj:
+            return None, False
+
+        return obj, obj.created_by_id == request.user.id
+
     def get_obj(self, request, pk):
         emp_list = []
         shift_list = []
-        creator = False
-        emp_obj = 0
-        try:
-            obj = Company.objects.get(id=pk, created_by=request.user)
-        except Company.DoesNotExist:
-            try:
-                obj = Company.objects.get(id=pk,
-                                          employees__user=request.user,
-                                          employees__is_deleted=False,
-                                          employees__is_accepted=True)
-            except Company.DoesNotExist:
-                obj = None
+        obj, creator = self.get_access(request, pk)
 
+        # The lists are only queried if the template renders them.
         if obj:
-            if obj.created_by == request.user:
-                emp_list, emp_obj = Employee.objects.get_paginated(request, company=obj)
-                creator = True
-
             if creator:
-                shift_list, _obj = Shift.objects.get_paginated(request, employee__company=obj)
+                emp_list = SimpleLazyObject(lambda: Employee.objects.get_paginated(request, company=obj)[0])
+                shift_list = SimpleLazyObject(lambda: Shift.objects.get_paginated(request, employee__company=obj)[0])
             else:
-                shift_list, _obj = Shift.objects.get_paginated(request,
-                                                               employee__user=request.user, employee__company=obj)
+                shift_list = SimpleLazyObject(lambda: Shift.objects.get_paginated(request,
+                                                                                  employee__user=request.user,
+                                                                                  employee__company=obj)[0])
 
         data = {
             'object': obj,
             'employees': emp_list,
-            'employees_c': emp_obj if emp_obj == 0 else emp_obj.count(),
+            'employees_c': SimpleLazyObject(lambda: emp_list.paginator.count) if creator else 0,
             'shift_list': shift_list,
             'is_creator': creator
         }
@@ -243,7 +231,7 @@ class CompanyDetailsView(LoginRequiredMixin, View):
 
         data.update({'title': f"{data['object'].name} Details"})
         data.update({'result': request.GET.get('result', '')})
-        data.update({'url_three': process_current_site_url(request)})
+        data.update({'url_three': breadcrumbs(request)})
         return render(request, 'panel/company/details.html', data)
 
     def post(self, request, pk):
@@ -262,11 +250,8 @@ class CompanyEditView(CompanyDetailsView):
     form_class = CompanyForm
 
     def get_obj(self, request, pk):
-        data = super().get_obj(request, pk)
-        if data['is_creator']:
-            return data['object']
-
-        return None
+        obj, creator = self.get_access(request, pk)
+        return obj if creator else None
 
     def get(self, request, pk):
         instance = self.get_obj(request, pk)
@@ -276,7 +261,7 @@ class CompanyEditView(CompanyDetailsView):
         data = {
             'title': f"Edit Company: {instance.name}",
             'form': self.form_class(instance=instance),
-            'url_three': process_current_site_url(request)
+            'url_three': breadcrumbs(request)
         }
         return render(request, 'panel/company/create.html', data)
 
@@ -294,7 +279,7 @@ class CompanyEditView(CompanyDetailsView):
 
         data = {
             'title': f"Edit Company: {instance.name}",
-            'url_three': process_current_site_url(request),
+            'url_three': breadcrumbs(request),
             'form': form
         }
         return render(request, 'panel/company/create.html', data)
@@ -305,29 +290,29 @@ class CompanyEmpAddView(CompanyDetailsView):
     form_class = EmployeeForm
 
     def get(self, request, pk):
-        check_data = self.get_obj(request, pk)
-        if not check_data['is_creator']:
+        obj, creator = self.get_access(request, pk)
+        if not creator:
             return redirect('manage-company', pk=pk)
 
         data = {
             'title': f"Add Employee",
             'form': EmployeeForm(request, pk),
-            'url_three': process_current_site_url(request)
+            'url_three': breadcrumbs(request)
         }
         return render(request, 'panel/company/add_employee.html', data)
 
     def post(self, request, pk):
-        check_data = self.get_obj(request, pk)
-        if not check_data['is_creator']:
+        obj, creator = self.get_access(request, pk)
+        if not creator:
             return redirect('manage-company', pk=pk)
 
         data = {
             'title': f"Add Employee",
-            'url_three': process_current_site_url(request)
+            'url_three': breadcrumbs(request)
         }
         form = EmployeeForm(request, pk, request.POST)
-        if form.is_valid():
-            obj = form.save()
+        obj = form.save_or_report() if form.is_valid() else None
+        if obj:
             data['result'] = f"{obj.user.username} ({obj.user.first_name} {obj.user.last_name}) added successfully!"
 
         data['form'] = form
@@ -335,6 +320,84 @@ class CompanyEmpAddView(CompanyDetailsView):
         return render(request, 'panel/company/add_employee.html', data)
 
 
+class CompanyEmpImportView(CompanyDetailsView):
+    login_url = 'login'
+    form_class = EmployeeImportForm
+
+    def render_form(self, request, form, result=None, errors=()):
+        data = {
+            'title': "Import Employees",
+            'form': form,
+            'result': result,
+            'errors': errors,
+            'url_three': breadcrumbs(request)
+        }
+        return render(request, 'panel/company/import_employees.html', data)
+
+    def get(self, request, pk):
+        obj, creator = self.get_access(request, pk)
+        if not creator:
+            return redirect('manage-company', pk=pk)
+
+        return self.render_form(request, self.form_class())
+
+    def post(self, request, pk):
+        obj, creator = self.get_access(request, pk)
+        if not creator:
+            return redirect('manage-company', pk=pk)
+
+        form = self.form_class(request.POST, request.FILES)
+        if not form.is_valid():
+            return self.render_form(request, form)
+
+        try:
+            rows = read_employee_csv(form.cleaned_data['file'])
+        except ValidationError as e:
+            return self.render_form(request, form, errors=e.messages)
+        except UnicodeDecodeError as e:
+            return self.render_form(request, form, errors=[str(e)])
+
+        employee_import = EmployeeImport(obj, request.user)
+        if not employee_import.validate(rows):
+            # Nothing is written unless the whole file is valid.
+            return self.render_form(request, form, errors=employee_import.errors)
+
+        count = employee_import.save()
+        return self.render_form(request, self.form_class(), result=f"{count} employees added successfully!")
+
+
+class CompanyExportView(CompanyDetailsView):
+    """Timesheet of every shift started in ?start=..&end=.. (inclusive dates, default: this month) as CSV or XLSX."""
+    login_url = 'login'
+    chunk_size = 2000
+
+    def get(self, request, pk):
+        obj, creator = self.get_access(request, pk)
+        if not creator:
+            return redirect('manage-company', pk=pk)
+
+        today = timezone.localdate()
+        try:
+            start = parse_date(request.GET.get('start', '')) or today.replace(day=1)
+            end = parse_date(request.GET.get('end', '')) or today
+        except ValueError:
+            return HttpResponseBadRequest("Dates must be given as YYYY-MM-DD.")
+        if end < start:
+            return HttpResponseBadRequest("The end date must not be before the start date.")
+
+        rows = timesheet_rows(obj.id, day_bounds(start)[0], day_bounds(end)[1], self.chunk_size)
+        filename = f"{slugify(obj.name)}-timesheet-{start}-{end}"
+
+        if request.GET.get('format') == 'xlsx':
+            if not XLSX_AVAILABLE:
+                return HttpResponseBadRequest("XLSX export is not available, install openpyxl.")
+            return FileResponse(write_xlsx(rows), as_attachment=True, filename=f"{filename}.xlsx")
+
+        response = StreamingHttpResponse(stream_csv(rows), content_type='text/csv')
+        response['Content-Disposition'] = f'attachment; filename="{filename}.csv"'
+        return response
+
+
 class CompanyShiftAddView(LoginRequiredMixin, View):
     login_url = 'login'
 
@@ -380,11 +443,14 @@ class AllEmployeesView(LoginRequiredMixin, View):
     def get(self, request):
         data = {
             'title': 'My Employees',
-            'url_three': process_current_site_url(request)
+            'url_three': breadcrumbs(request)
         }
-        obj_list, obj = Employee.objects.get_paginated(request,
-                                                       company__created_by=request.user,
-                                                       company__is_deleted=False)
+        versions = [probe(Employee.objects.filter(company_id__in=get_membership(request).owned),
+                          'user__profile', 'role', 'company')]
+        return conditional_response(request, versions, lambda: self.render_list(request, data), *user_scope(request))
+
+    def render_list(self, request, data):
+        obj_list, obj = Employee.objects.get_paginated(request, company_id__in=get_membership(request).owned)
         data['employees'] = obj_list
 
         return render(request, 'panel/employee/list.html', data)
@@ -396,21 +462,18 @@ class EmployeeDetailsView(LoginRequiredMixin, View):
     def get_obj(self, request, pk):
         shift_list = []
 
-        try:
-            obj = Employee.objects.get(id=pk, user=request.user)
-        except Employee.DoesNotExist:
-            try:
-                obj = Employee.objects.get(id=pk, company__created_by=request.user, company__is_deleted=False)
-            except Employee.DoesNotExist:
-                obj = None
+        visible = Q(user=request.user) | Q(company_id__in=get_membership(request).owned)
+        obj = (Employee.objects.select_related('user__profile', 'role', 'company__created_by')
+               .filter(visible, id=pk).first())
 
         if obj:
             shift_list, _obj = Shift.objects.get_paginated(request, employee=obj)
 
         data = {
             'object': obj,
+            # Versions the badge URL, so browsers may keep the image for as long as the uid stays the same.
+            'badge_version': obj and badge_digest(obj.uid)[:16],
             'shift_list': shift_list,
-            'object_qr': f'img/emp/{obj.uid}.png'
         }
 
         return data
@@ -420,11 +483,9 @@ class EmployeeDetailsView(LoginRequiredMixin, View):
         if not data['object']:
             return HttpResponseNotFound()
 
-        # generate_qr(data['object'].uid)
-
         data.update({
             'title': f"Employee Details",
-            'url_three': process_current_site_url(request)
+            'url_three': breadcrumbs(request)
         })
         return render(request, 'panel/employee/details.html', data)
 
@@ -437,3 +498,34 @@ class EmployeeDetailsView(LoginRequiredMixin, View):
         obj['object'].save()
 
         return redirect('all-employees')
+
+
+class EmployeeBadgeView(LoginRequiredMixin, View):
+    """QR badge of an employee's uid as SVG or PNG, cached in memory and on disk by content (helper/badge.py)."""
+    login_url = 'login'
+    max_age = 365 * 24 * 60 * 60
+
+    def get(self, request, pk, fmt):
+        if fmt not in badge_formats():
+            return HttpResponseNotFound()
+
+        visible = Q(user=request.user) | Q(company_id__in=get_membership(request).owned)
+        uid = Employee.objects.filter(visible, id=pk).values_list('uid', flat=True).first()
+        if not uid:
+            return HttpResponseNotFound()
+
+        digest = badge_digest(uid)
+        etag = quote_etag(f'{digest}.{fmt}')
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            digest, content = get_badge(uid, fmt)
+            response = HttpResponse(content, content_type=BADGE_CONTENT_TYPES[fmt])
+
+        response['ETag'] = etag
+        if request.GET.get('v') == digest[:16]:
+            # The details page links the badge with ?v=<digest>, and a new uid changes that URL.
+            patch_cache_control(response, private=True, max_age=self.max_age, immutable=True)
+        else:
+            # Without the current version the URL may outlive the uid, so it is revalidated by ETag.
+            patch_cache_control(response, private=True, no_cache=True)
+        return response